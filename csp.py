@@ -10,6 +10,13 @@ class Variable(object):
     A variable can be in the assigned state, in which v.is_assigned()
     will return true.
     """
+    # undo log of the state this variable belongs to; None unless the
+    # state is searched in trail mode (see CSPState.trailed_copy)
+    _trail = None
+    # the state to tell about changes of this variable; None unless the
+    # state has watchers (see CSPState.add_watcher)
+    _listener = None
+
     def __init__(self, name, domain, value=None):
         self._name = name
         self._domain = domain[:]
@@ -18,11 +25,29 @@ class Variable(object):
     def copy(self):
         return Variable(self._name, self._domain, self._value)
 
+    def set_trail(self, trail):
+        self._trail = trail
+
+    def set_listener(self, listener):
+        self._listener = listener
+
+    def _changed(self):
+        if self._listener is not None:
+            self._listener.variable_changed(self)
+
     def get_name(self):
         return self._name
 
     def reduce_domain(self, value):
-        self._domain.remove(value)
+        index = self._domain.index(value)
+        del self._domain[index]
+        if self._trail is not None:
+            self._trail.record(self._restore_domain_value, index, value)
+        self._changed()
+
+    def _restore_domain_value(self, index, value):
+        self._domain.insert(index, value)
+        self._changed()
 
     def domain_size(self):
         return len(self._domain)
@@ -30,6 +55,9 @@ class Variable(object):
     def get_domain(self):
         return self._domain[:]
 
+    def in_domain(self, value):
+        return value in self._domain
+
     def is_assigned(self):
         return self._value is not None
 
@@ -37,7 +65,14 @@ class Variable(object):
         return self._value
 
     def set_value(self, value):
+        if self._trail is not None:
+            self._trail.record(self._restore_value, self._value)
+        self._value = value
+        self._changed()
+
+    def _restore_value(self, value):
         self._value = value
+        self._changed()
 
     def __str__(self):
         buf = "%s(%s)" %(self._name, self._domain)
@@ -45,12 +80,136 @@ class Variable(object):
             buf += ": %s" %(self._value)
         return buf
 
+class BitsetVariable(Variable):
+    """
+    A Variable whose domain is an int bitmask over a table of values.
+    Bit k of the mask is set while the k-th value of the table is still
+    in the domain.  The table is built once and shared by all copies of
+    the variable, so copying, snapshotting and backtracking only deal
+    with an int.  Values must be hashable.
+
+    Besides the Variable interface, the mask methods let propagators
+    work on whole sets of values at once, e.g.
+    var.intersect_mask(var.mask_of(allowed_values)).
+
+    A ready-made table can be passed as domain together with positions,
+    a mapping from its values to their index (supporting [], get() and
+    in); both are then used as they are, and shared.
+    """
+    def __init__(self, name, domain, value=None, positions=None):
+        self._name = name
+        self._value = value
+        if positions is None:
+            values = []
+            positions = {}
+            for v in domain:
+                if v not in positions:
+                    positions[v] = len(values)
+                    values.append(v)
+            domain = tuple(values)
+        self._values = domain
+        self._positions = positions
+        self._mask = (1 << len(domain)) - 1
+        self._size = len(domain)
+
+    def copy(self):
+        variable = object.__new__(self.__class__)
+        variable.__dict__.update(self.__dict__)
+        # a copy is not part of the state this one reports to
+        variable.__dict__.pop('_trail', None)
+        variable.__dict__.pop('_listener', None)
+        return variable
+
+    def reduce_domain(self, value):
+        bit = 1 << self._positions[value]
+        if not self._mask & bit:
+            raise ValueError("%s is not in the domain of %s"
+                             %(value, self._name))
+        self.set_mask(self._mask & ~bit)
+
+    def domain_size(self):
+        return self._size
+
+    def get_domain(self):
+        values = self._values
+        domain = []
+        mask = self._mask
+        while mask:
+            low = mask & -mask
+            domain.append(values[low.bit_length() - 1])
+            mask ^= low
+        return domain
+
+    def in_domain(self, value):
+        position = self._positions.get(value)
+        return position is not None and bool(self._mask >> position & 1)
+
+    def get_mask(self):
+        return self._mask
+
+    def set_mask(self, mask):
+        """
+        Replace the domain by the values whose bits are set in mask.
+        This is also how a snapshot taken with get_mask() is restored.
+        """
+        if self._trail is not None:
+            self._trail.record(self._restore_mask, self._mask, self._size)
+        self._mask = mask
+        self._size = bin(mask).count("1")
+        self._changed()
+
+    def _restore_mask(self, mask, size):
+        self._mask = mask
+        self._size = size
+        self._changed()
+
+    def intersect_mask(self, mask):
+        """
+        Keep only the values whose bits are also set in mask.
+        Returns the new domain size.
+        """
+        if self._mask & mask != self._mask:
+            self.set_mask(self._mask & mask)
+        return self._size
+
+    def remove_mask(self, mask):
+        """
+        Remove the values whose bits are set in mask.
+        Returns the new domain size.
+        """
+        return self.intersect_mask(~mask)
+
+    def mask_of(self, values):
+        """
+        Bitmask of the given values (values not in the table are
+        ignored).
+        """
+        mask = 0
+        positions = self._positions
+        for v in values:
+            if v in positions:
+                mask |= 1 << positions[v]
+        return mask
+
+    def get_value_table(self):
+        """
+        The values the bits of the mask stand for, in bit order.
+        """
+        return self._values
+
+    def __str__(self):
+        buf = "%s(%s)" %(self._name, self.get_domain())
+        if self._value is not None:
+            buf += ": %s" %(self._value)
+        return buf
+
 class BinaryConstraint:
     """
     Representation of a binary-constraint on two variables variable i and
     variable j.
     """
-    def __init__(self, var_i_name, var_j_name, check_func, description=None):
+    def __init__(self, var_i_name, var_j_name, check_func, description=None,
+                 pure=False):
         """
         * var_i_name, var_j_name are the names of the variables.
         * check_func is a function that takes four arguments value_i and
@@ -59,11 +218,21 @@ class BinaryConstraint:
         the values passes the constraint, false otherwise.
         * description is a string descriptor of the constraint (helpful
         to determine what constraints triggered a search failure.
+        * pure declares that check_func depends on nothing but its
+        arguments and has no side effects, so its results may be
+        memoized (see CSP.memoize_constraints).
         """
         self.var_i_name = var_i_name
         self.var_j_name = var_j_name
         self.check_func = check_func
         self.description = description
+        self.pure = pure
+        # the allowed-pair ConstraintTable, once CSP.compile_constraints()
+        # has compiled this constraint
+        self.table = None
+        # the CheckCache shared by the problem, once
+        # CSP.memoize_constraints() has been called for a pure constraint
+        self.memo = None
 
     def get_variable_i_name(self):
         return self.var_i_name
@@ -71,6 +240,9 @@ class BinaryConstraint:
     def get_variable_j_name(self):
         return self.var_j_name
 
+    def get_variable_names(self):
+        return (self.var_i_name, self.var_j_name)
+
     def check(self, state, value_i=None, value_j=None):
         """
         state is the csp state and should be an instance of
@@ -80,19 +252,27 @@ class BinaryConstraint:
         fetched from the state by looking up variable_i and variable_j's
         names.
         """
-        variable_i = state.get_variable_by_name(self.var_i_name)
-        if value_i is None and variable_i is not None:
-            value_i = variable_i.get_assigned_value()
+        if value_i is None:
+            variable_i = state.get_variable_by_name(self.var_i_name)
+            if variable_i is not None:
+                value_i = variable_i.get_assigned_value()
 
-        variable_j = state.get_variable_by_name(self.var_j_name)
-        if value_j is None and variable_j is not None:
-            value_j = variable_j.get_assigned_value()
+        if value_j is None:
+            variable_j = state.get_variable_by_name(self.var_j_name)
+            if variable_j is not None:
+                value_j = variable_j.get_assigned_value()
 
         if value_i is not None and value_j is not None:
+            if self.table is not None:
+                allowed = self.table.allows(value_i, value_j)
+                if allowed is not None:
+                    return allowed
+            if self.memo is not None:
+                return self.memo.check(self, value_i, value_j)
             return self.check_func(value_i, value_j,
                                    self.var_i_name, self.var_j_name)
-	else:
-	    raise Exception("neither value_i nor value_j are set")
+        else:
+            raise Exception("neither value_i nor value_j are set")
 
         # if values of i or j are not set, we really can't check
         # this constraint.  So the check passes.
@@ -108,6 +288,204 @@ class BinaryConstraint:
             name += " : %s" %(self.description)
         return name
 
+class ConstraintTable(object):
+    """
+    Extensional form of a binary constraint over finite domains: for
+    each value of variable i, a bitmask over the values of variable j
+    it is allowed with (and the other way around).  Bit k stands for the
+    k-th value of values_j (values_i).  When these are the value tables
+    of BitsetVariables, the masks can be applied to their domains
+    directly.
+    """
+    def __init__(self, constraint, values_i, values_j):
+        self.values_i = values_i
+        self.values_j = values_j
+        self._positions_i = dict((v, k) for k, v in enumerate(values_i))
+        self._positions_j = dict((v, k) for k, v in enumerate(values_j))
+        self._rows = {}
+        columns = [0] * len(values_j)
+        name_i = constraint.get_variable_i_name()
+        name_j = constraint.get_variable_j_name()
+        for a, value_i in enumerate(values_i):
+            row = 0
+            for b, value_j in enumerate(values_j):
+                if constraint.check_func(value_i, value_j, name_i, name_j):
+                    row |= 1 << b
+                    columns[b] |= 1 << a
+            self._rows[value_i] = row
+        self._columns = dict(zip(values_j, columns))
+
+    def allows(self, value_i, value_j):
+        """
+        Whether the pair is allowed, None if either value is not in
+        the table.
+        """
+        row = self._rows.get(value_i)
+        position = self._positions_j.get(value_j)
+        if row is None or position is None:
+            return None
+        return bool(row >> position & 1)
+
+    def row(self, value_i):
+        """
+        Mask over values_j of the values allowed with value_i.
+        """
+        return self._rows.get(value_i)
+
+    def column(self, value_j):
+        """
+        Mask over values_i of the values allowed with value_j.
+        """
+        return self._columns.get(value_j)
+
+    def filters_j(self, variable):
+        """
+        Whether the rows can be applied to the domain of variable.
+        """
+        return isinstance(variable, BitsetVariable) and \
+            variable.get_value_table() is self.values_j
+
+    def filters_i(self, variable):
+        """
+        Whether the columns can be applied to the domain of variable.
+        """
+        return isinstance(variable, BitsetVariable) and \
+            variable.get_value_table() is self.values_i
+
+from collections import OrderedDict
+
+class CheckCache(object):
+    """
+    Bounded least-recently-used memo of check_func results, keyed on the
+    constraint and the pair of values.  A single cache is shared by all
+    the pure constraints of a problem.  Pairs of unhashable values are
+    checked without being memoized.
+    """
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self._results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def check(self, constraint, value_i, value_j):
+        key = (constraint, value_i, value_j)
+        results = self._results
+        try:
+            result = results.pop(key)
+        except KeyError:
+            pass
+        except TypeError:
+            return constraint.check_func(value_i, value_j,
+                                         constraint.var_i_name,
+                                         constraint.var_j_name)
+        else:
+            # re-inserted as the most recently used
+            results[key] = result
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        result = constraint.check_func(value_i, value_j,
+                                       constraint.var_i_name,
+                                       constraint.var_j_name)
+        results[key] = result
+        self._evict()
+        return result
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        self._evict()
+
+    def _evict(self):
+        results = self._results
+        while len(results) > self.max_size:
+            results.popitem(last=False)
+            self.evictions += 1
+
+    def statistics(self):
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self._results),
+                'max_size': self.max_size,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+    def clear(self):
+        self._results.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._results)
+
+class ConstraintIndex(object):
+    """
+    Read-only index from variable names to the constraints they take
+    part in.  It is built once per problem and shared, without copying,
+    by every state of the search.
+
+    A binary constraint is listed as outgoing only for its variable i
+    (the one get_constraints_by_name() has always reported it for) and
+    as incident for both of its variables.  Any other constraint, such
+    as a global constraint over many variables, is listed as outgoing
+    and incident for each of its variables.
+    """
+    def __init__(self, constraints):
+        outgoing = {}
+        incident = {}
+        for constraint in constraints:
+            names = []
+            for name in constraint.get_variable_names():
+                if name not in names:
+                    names.append(name)
+            for name in names:
+                incident.setdefault(name, []).append(constraint)
+            if isinstance(constraint, BinaryConstraint):
+                names = [constraint.get_variable_i_name()]
+            for name in names:
+                outgoing.setdefault(name, []).append(constraint)
+
+        self._all = tuple(constraints)
+        self._outgoing = dict((name, tuple(lst))
+                              for name, lst in outgoing.items())
+        self._incident = dict((name, tuple(lst))
+                              for name, lst in incident.items())
+
+    def outgoing(self, variable_name):
+        return self._outgoing.get(variable_name, ())
+
+    def incident(self, variable_name):
+        return self._incident.get(variable_name, ())
+
+    def all(self):
+        return self._all
+
+class Trail(object):
+    """
+    An undo log of the in-place modifications made to a VD table.
+    Every modification records a function (and its arguments) that
+    reverts it; undo_to() replays them in reverse order until the log
+    is back at a previously taken mark.
+    """
+    def __init__(self):
+        self._entries = []
+
+    def mark(self):
+        return len(self._entries)
+
+    def record(self, undo_func, *args):
+        self._entries.append((undo_func, args))
+
+    def undo_to(self, mark):
+        entries = self._entries
+        while len(entries) > mark:
+            undo_func, args = entries.pop()
+            undo_func(*args)
+
+    def __len__(self):
+        return len(self._entries)
+
 class CSPState:
     """
     Representation of a single state in the CSP search tree.  One can
@@ -117,7 +495,9 @@ class CSPState:
                  constraint_map,
                  variable_map,
                  variable_order,
-                 variable_index):
+                 variable_index,
+                 trail=None,
+                 constraint_index=None):
         """
         constraint_map - a dictionary of variable names to
                          lists of associated constraints
@@ -127,11 +507,29 @@ class CSPState:
                        values are the names of variables
         variable_index - the position into the variable_order in which
                        we are currently making an assignment.
+        trail - the Trail recording modifications of this state, or None
+                when the state is copied rather than undone.
+        constraint_index - the ConstraintIndex of the problem; built
+                from constraint_map when not given.
+
+        A state may also carry watchers: objects that keep some summary
+        of the VD table (such as the queue of a VariableSelector) up to
+        date.  Each watcher is told about every change of a variable
+        through variable_changed(variable), and is copied with copy()
+        along with the state.
         """
         self.constraint_map = constraint_map
         self.variable_map = variable_map
         self.variable_order = variable_order
         self.variable_index = variable_index
+        self.trail = trail
+        if constraint_index is None:
+            constraints = []
+            for val in constraint_map.values():
+                constraints += val
+            constraint_index = ConstraintIndex(constraints)
+        self.constraint_index = constraint_index
+        self.watchers = {}
 
     def copy(self):
         """
@@ -143,32 +541,81 @@ class CSPState:
         new_variable_map = {}
         for var_name, variable in self.variable_map.items():
             new_variable_map[var_name] = variable.copy()
-        new_state = CSPState(self.constraint_map,
-                             new_variable_map,
-                             self.variable_order,
-                             self.variable_index)
+        new_state = self.__class__(self.constraint_map,
+                                   new_variable_map,
+                                   self.variable_order,
+                                   self.variable_index,
+                                   constraint_index=self.constraint_index)
+        if self.watchers:
+            for key, watcher in self.watchers.items():
+                new_state.watchers[key] = watcher.copy()
+            for variable in new_variable_map.values():
+                variable.set_listener(new_state)
         return new_state
 
+    def add_watcher(self, key, watcher):
+        """
+        Register watcher under key; from now on it is told about every
+        change of the variables of this state.
+        """
+        self.watchers[key] = watcher
+        for variable in self.variable_map.values():
+            variable.set_listener(self)
+
+    def get_watcher(self, key):
+        return self.watchers.get(key)
+
+    def variable_changed(self, variable):
+        for watcher in self.watchers.values():
+            watcher.variable_changed(variable)
+
+    def trailed_copy(self):
+        """
+        Make a copy of this state that is modified in place and
+        backtracked through its trail instead of being copied per child.
+        Assignments and domain reductions made on the copy are recorded
+        and can be reverted with undo().
+        """
+        new_state = self.copy()
+        new_state.trail = Trail()
+        for variable in new_state.variable_map.values():
+            variable.set_trail(new_state.trail)
+        return new_state
+
+    def mark(self):
+        """
+        Return a position in the trail that undo() can go back to.
+        """
+        return self.trail.mark()
+
+    def undo(self, mark):
+        """
+        Revert every assignment and domain reduction made since mark.
+        """
+        self.trail.undo_to(mark)
+
+    def _restore_variable_index(self, variable_index):
+        self.variable_index = variable_index
+
     def get_constraints_by_name(self, variable_name):
         """
         List only constraints associated with variable_name
         (where variable_name is variable_i in the constraint)
         """
-        constraints = []
-        for key, val in self.constraint_map.items():
-            v_i, v_j = key
-            if v_i == variable_name:
-                constraints += val
-        return constraints
+        return self.constraint_index.outgoing(variable_name)
+
+    def get_incident_constraints(self, variable_name):
+        """
+        List the constraints variable_name takes part in, whichever
+        side of the constraint it is on.
+        """
+        return self.constraint_index.incident(variable_name)
 
     def get_all_constraints(self):
         """
         List all the constraints in this problem
         """
-        constraints = []
-        for key, val in self.constraint_map.items():
-            constraints += val
-        return constraints
+        return self.constraint_index.all()
 
     def get_all_variables(self):
         """
@@ -205,6 +652,9 @@ class CSPState:
         variable = self.get_variable_by_index(variable_index)
         if variable is not None:
             variable.set_value(variable_value)
+            if self.trail is not None:
+                self.trail.record(self._restore_variable_index,
+                                  self.variable_index)
             self.variable_index = variable_index
 
     def get_variable_by_index(self, index):
@@ -286,11 +736,479 @@ def basic_constraint_checker(state, verbose=False):
             return False
     return True
 
+def incremental_constraint_checker(state, verbose=False):
+    """
+    Constraint checker that only checks the constraints incident to
+    the variable assigned last.  Every ancestor of the state has already
+    passed the check of its own assignment, so the constraints between
+    earlier variables need not be checked again and the cost per node
+    grows with the degree of the variable rather than with the number
+    of constraints.  Pass it to CSP.solve() in place of
+    basic_constraint_checker.
+    """
+    var_name = state.get_current_variable_name()
+    if var_name is None:
+        # ROOT
+        return True
+
+    for constraint in state.get_incident_constraints(var_name):
+        var_i = state.get_variable_by_name(constraint.get_variable_i_name())
+        var_j = state.get_variable_by_name(constraint.get_variable_j_name())
+
+        if not var_i.is_assigned() or not var_j.is_assigned():
+            continue
+
+        if not constraint.check(state):
+            if verbose:
+                print "CONSTRAINT-FAILS: %s" %(constraint)
+            return False
+    return True
+
+import heapq
+import random
+
+class VariableSelector(object):
+    """
+    Chooses the variable CSP.solve() assigns next.  This one assigns
+    the variables in variable_order, as CSP.solve() always has.
+    """
+    def start(self, state):
+        """
+        Called with the initial state before the search starts.
+        """
+        pass
+
+    def select(self, state):
+        """
+        Return the index (into state.variable_order) of the variable
+        to assign in the children of state.
+        """
+        return state.variable_index + 1
+
+    def failed(self, state):
+        """
+        Called for every state the constraint checker rejects.
+        """
+        pass
+
+class MinimumRemainingValues(VariableSelector):
+    """
+    Assign first the unassigned variable with the smallest domain (MRV).
+    With degree_tie_break, ties go to the variable with the most
+    neighbours (the static degree in the constraint graph); remaining
+    ties go to the earlier variable in variable_order.
+
+    The unassigned variables are kept in a priority queue watching the
+    state, so domain reductions and assignments update it as they happen
+    and choosing a variable does not scan the VD table.
+    """
+    def __init__(self, degree_tie_break=False):
+        self.degree_tie_break = degree_tie_break
+        self._degrees = {}
+        # the variable names of every constraint whose weight changed
+        # (see DomOverWDeg), oldest first; a queue catches up on the
+        # ones it has not seen when it is selected from
+        self.reweighted = []
+
+    def key(self, variable, unassigned):
+        """
+        Priority of an unassigned variable, the smallest goes first.
+        unassigned holds the names of the unassigned variables.
+        """
+        if self.degree_tie_break:
+            return (variable.domain_size(), -self._degrees[variable.get_name()])
+        return (variable.domain_size(),)
+
+    def dependents(self, name):
+        """
+        Names of the other variables whose key changes when the
+        variable name is assigned or unassigned.
+        """
+        return ()
+
+    def start(self, state):
+        if self.degree_tie_break:
+            for name in state.variable_order:
+                neighbours = set()
+                for constraint in state.get_incident_constraints(name):
+                    neighbours.update(constraint.get_variable_names())
+                neighbours.discard(name)
+                self._degrees[name] = len(neighbours)
+        state.add_watcher(self, _VariableQueue(self, state))
+
+    def select(self, state):
+        return state.get_watcher(self).select(state)
+
+class DomOverWDeg(MinimumRemainingValues):
+    """
+    dom/wdeg: assign first the variable with the smallest ratio of
+    domain size to weighted degree.  Every constraint has a weight,
+    starting at one, and the weighted degree of a variable is the sum of
+    the weights of its constraints that still have another unassigned
+    variable; variables without any go last.  With degree_tie_break,
+    ties go to the variable with the most neighbours.
+
+    When the constraint checker rejects an assignment, the weight of
+    each constraint of the variable just assigned that is to blame goes
+    up by one: one that fails its check, or that links the variable to
+    one whose domain is wiped out.  Weights are kept across backtracking
+    so the search learns which constraints are hard.  A weight change
+    only re-keys the variables of that constraint, and an assignment the
+    neighbours of the variable.
+    """
+    def __init__(self, degree_tie_break=False):
+        MinimumRemainingValues.__init__(self, degree_tie_break)
+        # constraint -> its weight, when it is not one
+        self._weights = {}
+        # var name -> its constraints, and the other variables of them
+        self._incident = {}
+        self._neighbours = {}
+
+    def key(self, variable, unassigned):
+        name = variable.get_name()
+        weighted_degree = 0
+        for constraint in self._incident[name]:
+            for other in constraint.get_variable_names():
+                if other != name and other in unassigned:
+                    weighted_degree += self._weights.get(constraint, 1)
+                    break
+        if weighted_degree:
+            ratio = variable.domain_size() / float(weighted_degree)
+        else:
+            ratio = float('inf')
+        if self.degree_tie_break:
+            return (ratio, -self._degrees[name])
+        return (ratio,)
+
+    def dependents(self, name):
+        return self._neighbours[name]
+
+    def start(self, state):
+        for name in state.variable_order:
+            constraints = state.get_incident_constraints(name)
+            neighbours = set()
+            for constraint in constraints:
+                neighbours.update(constraint.get_variable_names())
+            neighbours.discard(name)
+            self._incident[name] = constraints
+            self._neighbours[name] = neighbours
+        MinimumRemainingValues.start(self, state)
+
+    def failed(self, state):
+        name = state.get_current_variable_name()
+        if name is None:
+            return
+        for constraint in self._incident[name]:
+            if self._to_blame(state, constraint, name):
+                self._weights[constraint] = \
+                    self._weights.get(constraint, 1) + 1
+                self.reweighted.append(constraint.get_variable_names())
+
+    def _to_blame(self, state, constraint, name):
+        others = [state.get_variable_by_name(other)
+                  for other in constraint.get_variable_names()
+                  if other != name]
+        for other in others:
+            if not other.is_assigned() and other.domain_size() == 0:
+                return True
+        if isinstance(constraint, BinaryConstraint) and \
+                not all(other.is_assigned() for other in others):
+            return False
+        return not constraint.check(state)
+
+class _VariableQueue(object):
+    """
+    State watcher of MinimumRemainingValues: a heap of
+    (key, position in variable_order, name) entries of the unassigned
+    variables.  Entries are not removed when a key changes; a new one is
+    pushed and outdated ones are dropped when they reach the top.  The
+    keys that change without their variable changing (the dependents of
+    a variable assigned or unassigned, the variables of a reweighted
+    constraint) are recomputed when the queue is next selected from.
+    """
+    def __init__(self, selector, state=None):
+        self._selector = selector
+        self._seen = len(selector.reweighted)
+        self._heap = []
+        self._keys = {}
+        self._positions = {}
+        # unassigned variables whose key may be out of date
+        self._stale = set()
+        if state is not None:
+            for position, name in enumerate(state.variable_order):
+                self._positions[name] = position
+                if not state.get_variable_by_name(name).is_assigned():
+                    self._keys[name] = None
+            for name in self._keys:
+                key = selector.key(state.get_variable_by_name(name),
+                                   self._keys)
+                self._keys[name] = key
+                self._heap.append((key, self._positions[name], name))
+            heapq.heapify(self._heap)
+
+    def copy(self):
+        queue = _VariableQueue(self._selector)
+        queue._seen = self._seen
+        queue._heap = self._heap[:]
+        queue._keys = self._keys.copy()
+        queue._positions = self._positions
+        queue._stale = set(self._stale)
+        return queue
+
+    def variable_changed(self, variable):
+        name = variable.get_name()
+        if variable.is_assigned():
+            if name in self._keys:
+                del self._keys[name]
+                self._stale.update(self._selector.dependents(name))
+            return
+        if name not in self._keys:
+            self._stale.update(self._selector.dependents(name))
+        self._push(name, self._selector.key(variable, self._keys))
+
+    def _push(self, name, key):
+        if self._keys.get(name) != key:
+            self._keys[name] = key
+            heapq.heappush(self._heap, (key, self._positions[name], name))
+            if len(self._heap) > 4 * len(self._positions) + 16:
+                self._compact()
+
+    def _compact(self):
+        keys = self._keys
+        self._heap = [entry for entry in self._heap
+                      if keys.get(entry[2]) == entry[0]]
+        heapq.heapify(self._heap)
+
+    def select(self, state):
+        reweighted = self._selector.reweighted
+        if self._seen < len(reweighted):
+            for names in reweighted[self._seen:]:
+                self._stale.update(names)
+            self._seen = len(reweighted)
+        if self._stale:
+            for name in self._stale:
+                if name in self._keys:
+                    self._push(name, self._selector.key(
+                        state.get_variable_by_name(name), self._keys))
+            self._stale.clear()
+        heap = self._heap
+        keys = self._keys
+        while heap:
+            key, position, name = heap[0]
+            if keys.get(name) != key:
+                heapq.heappop(heap)
+                continue
+            return position
+        return None
+
+class ValueOrder(object):
+    """
+    Orders the values CSP.solve() tries for a variable.  This one tries
+    them in domain order, as CSP.solve() always has.
+    """
+    def start(self, state):
+        """
+        Called with the initial state before the search starts.
+        """
+        pass
+
+    def order(self, state, variable_index):
+        """
+        Return an iterable over the values to try for the
+        variable_index(th) variable in the children of state.
+        """
+        return state.get_variable_by_index(variable_index).get_domain()
+
+class RandomValueOrder(ValueOrder):
+    """
+    Tries the values in a random order, reproducible from seed.  Runs
+    that differ only in their seed explore the tree differently, which
+    is what a portfolio (see solve_portfolio) draws on.
+    """
+    def __init__(self, seed=None):
+        self.seed = seed
+        self._random = random.Random(seed)
+
+    def start(self, state):
+        self._random.seed(self.seed)
+
+    def order(self, state, variable_index):
+        values = list(state.get_variable_by_index(variable_index).get_domain())
+        self._random.shuffle(values)
+        return values
+
+def _keep_only(variable, value):
+    """
+    Reduce the domain of variable to value.
+    """
+    if isinstance(variable, BitsetVariable):
+        variable.intersect_mask(variable.mask_of([value]))
+        return
+    for other in list(variable.get_domain()):
+        if other != value:
+            variable.reduce_domain(other)
+
+class _PreferredValueOrder(ValueOrder):
+    """
+    Puts the preferred value of a variable (from a dict of names to
+    values) in front of the order of value_order.  Used by CSP.repair().
+    """
+    def __init__(self, preferred, value_order):
+        self._preferred = preferred
+        self._value_order = value_order
+
+    def start(self, state):
+        self._value_order.start(state)
+
+    def order(self, state, variable_index):
+        values = self._value_order.order(state, variable_index)
+        name = state.variable_order[variable_index]
+        if name not in self._preferred:
+            return values
+        values = list(values)
+        preferred = self._preferred[name]
+        if preferred in values:
+            values.remove(preferred)
+            values.insert(0, preferred)
+        return values
+
+class LeastConstrainingValue(ValueOrder):
+    """
+    Least-constraining-value (LCV) ordering: try first the values that
+    rule out the fewest values of the unassigned neighbours through
+    binary constraints.
+
+    The number of conflicting neighbour values of every value is kept
+    by a watcher of the state and adjusted as neighbour domains shrink,
+    grow back or get assigned, so ordering a domain is a sort on cached
+    counts.  The outcome of each constraint check is cached as well.
+    """
+    def __init__(self):
+        self._compatible = {}
+
+    def start(self, state):
+        state.add_watcher(self, _ConflictCounts(self, state))
+
+    def order(self, state, variable_index):
+        variable = state.get_variable_by_index(variable_index)
+        counts = state.get_watcher(self).get_counts(variable.get_name())
+        return sorted(variable.get_domain(), key=lambda x: counts.get(x, 0))
+
+    def compatible(self, state, constraint, is_i, value, other_value):
+        """
+        Whether value of the variable on side i (is_i) or j of
+        constraint is compatible with other_value on the other side.
+        """
+        key = (constraint, is_i, value, other_value)
+        result = self._compatible.get(key)
+        if result is None:
+            if is_i:
+                result = constraint.check(state, value, other_value)
+            else:
+                result = constraint.check(state, other_value, value)
+            result = bool(result)
+            self._compatible[key] = result
+        return result
+
+class _ConflictCounts(object):
+    """
+    State watcher of LeastConstrainingValue.  For every variable X and
+    value x of its initial domain it counts the values y of unassigned
+    neighbours Y with which x conflicts.  The counts of a variable are
+    shared with copies of the watcher until one of them changes them.
+    """
+    def __init__(self, value_order, state=None):
+        self._value_order = value_order
+        if state is None:
+            return
+        self._state = state
+        # name -> (constraint, is_i, neighbour name) for each binary
+        # constraint between name and another variable
+        self._arcs = {}
+        for name in state.variable_order:
+            arcs = []
+            for constraint in state.get_incident_constraints(name):
+                if not isinstance(constraint, BinaryConstraint):
+                    continue
+                i = constraint.get_variable_i_name()
+                j = constraint.get_variable_j_name()
+                if i == j:
+                    continue
+                if i == name:
+                    arcs.append((constraint, True, j))
+                else:
+                    arcs.append((constraint, False, i))
+            self._arcs[name] = arcs
+        # values of each variable currently counted against its
+        # neighbours: its domain, or nothing once it is assigned
+        self._counted = {}
+        self._counts = {}
+        self._owned = set(state.variable_order)
+        for name in state.variable_order:
+            variable = state.get_variable_by_name(name)
+            self._counted[name] = self._values_to_count(variable)
+            self._counts[name] = dict((x, 0) for x in variable.get_domain())
+        for name in state.variable_order:
+            for y in self._counted[name]:
+                self._adjust(name, y, 1)
+
+    def copy(self):
+        counts = _ConflictCounts(self._value_order)
+        counts._state = self._state
+        counts._arcs = self._arcs
+        counts._counted = self._counted.copy()
+        counts._counts = self._counts.copy()
+        counts._owned = set()
+        self._owned = set()
+        return counts
+
+    def get_counts(self, name):
+        return self._counts[name]
+
+    def _values_to_count(self, variable):
+        if variable.is_assigned():
+            return frozenset()
+        return frozenset(variable.get_domain())
+
+    def _adjust(self, name, y, delta):
+        """
+        Add delta to the count of every neighbour value that conflicts
+        with value y of name.
+        """
+        compatible = self._value_order.compatible
+        for constraint, is_i, other in self._arcs[name]:
+            if other not in self._owned:
+                self._counts[other] = self._counts[other].copy()
+                self._owned.add(other)
+            counts = self._counts[other]
+            for x in counts:
+                if not compatible(self._state, constraint, not is_i, x, y):
+                    counts[x] += delta
+
+    def variable_changed(self, variable):
+        name = variable.get_name()
+        old = self._counted[name]
+        new = self._values_to_count(variable)
+        if old == new:
+            return
+        self._counted[name] = new
+        for y in old - new:
+            self._adjust(name, y, -1)
+        for y in new - old:
+            self._adjust(name, y, 1)
+
 class CSP:
     """
     Top-level wrapper object that encapsulates all the
     variables and constraints of a CSP problem
     """
+    # How much of the search tree solve() records and returns:
+    # nothing, only the label, status and step of each examined node,
+    # or every node together with its state.
+    TREE_NONE = "none"
+    TREE_COMPACT = "compact"
+    TREE_FULL = "full"
+
     def __init__(self, constraints, variables):
         # Step 1: generate a constraint map, a mapping of pairs of
         # variable names to defined constraints on that pair.
@@ -305,6 +1223,9 @@ class CSP:
             else:
                 lst = self.constraint_map[tup]
             lst.append(constraint)
+        self.constraint_index = ConstraintIndex(constraints)
+        self.constraint_tables = {}
+        self.check_cache = None
 
         # Step 2: generate the variable map,
         self.variable_map = {}
@@ -313,16 +1234,77 @@ class CSP:
             self.variable_map[var.get_name()] = var
             self.variable_order.append(var.get_name())
 
+    def compile_constraints(self, max_pairs=None):
+        """
+        Turn the binary constraints of this problem into allowed-pair
+        ConstraintTables over the current domains of their variables,
+        so that checking them is a table lookup and filtering a domain
+        against an assigned value is a bitwise and.  Tables are cached
+        on the problem, so every state and every later solve() uses
+        them; constraints with more than max_pairs value pairs are left
+        alone.
+
+        returns the number of constraints compiled.
+        """
+        compiled = 0
+        for constraint in self.constraint_index.all():
+            if not isinstance(constraint, BinaryConstraint):
+                continue
+            if constraint in self.constraint_tables:
+                continue
+            values_i = self._value_table(constraint.get_variable_i_name())
+            values_j = self._value_table(constraint.get_variable_j_name())
+            if max_pairs is not None and \
+                    len(values_i) * len(values_j) > max_pairs:
+                continue
+            table = ConstraintTable(constraint, values_i, values_j)
+            self.constraint_tables[constraint] = table
+            constraint.table = table
+            compiled += 1
+        return compiled
+
+    def memoize_constraints(self, max_size=4096):
+        """
+        Memoize the check_func results of the binary constraints that
+        are declared pure, in one LRU cache of at most max_size entries
+        shared by every state and every later solve().  Calling it
+        again resizes the cache.
+
+        returns the CheckCache, whose statistics() reports hits,
+        misses and evictions.
+        """
+        if self.check_cache is None:
+            self.check_cache = CheckCache(max_size)
+        else:
+            self.check_cache.resize(max_size)
+        for constraint in self.constraint_index.all():
+            if isinstance(constraint, BinaryConstraint) and constraint.pure:
+                constraint.memo = self.check_cache
+        return self.check_cache
+
+    def _value_table(self, name):
+        variable = self.variable_map[name]
+        if isinstance(variable, BitsetVariable):
+            return variable.get_value_table()
+        return tuple(variable.get_domain())
+
     def initial_state(self):
         """
         Returns the starting state of the CSP with no variables assigned.
         """
         return CSPState(self.constraint_map, self.variable_map,
-                        self.variable_order, -1)
+                        self.variable_order, -1,
+                        constraint_index=self.constraint_index)
 
     def solve(self,
               constraint_checker=basic_constraint_checker,
-              verbose=False):
+              verbose=False,
+              use_trail=False,
+              record_tree=TREE_FULL,
+              variable_selector=None,
+              value_order=None,
+              backjumping=False,
+              prefix=()):
         """
         Perform a depth-first search with backtracking to solve
         This CSP problem.
@@ -331,56 +1313,625 @@ class CSP:
         propagation on a CSPState.  By default the checker does
         basic constraint checking (without propagation).
 
-        returns the solution state, and the search tree.
+        When use_trail is true a single state is modified in place and
+        backtracking undoes the recorded assignments and domain
+        reductions, instead of deep-copying the VD table for every child.
+        The nodes of the search tree then only keep the name of the
+        variable they assign, not a state of their own.
+
+        Children are generated lazily: the stack holds one frame per
+        expanded node with an iterator over the domain of the next
+        variable, and a child is only built when the search gets to it.
+        The search tree therefore only contains the nodes that were
+        examined.
+
+        record_tree is one of CSP.TREE_NONE, CSP.TREE_COMPACT and
+        CSP.TREE_FULL.  With TREE_FULL (the default) every node keeps
+        its state.  With TREE_COMPACT the nodes only keep their label,
+        status and step, and with TREE_NONE no tree is kept at all, so
+        memory stays bounded by the depth of the search.  In trail mode
+        there is only one state, so TREE_FULL records a compact tree.
+        Counts of the search are left in self.statistics either way.
+
+        variable_selector is a VariableSelector that picks the variable
+        each node assigns next: VariableSelector() (the default) follows
+        variable_order, MinimumRemainingValues() and DomOverWDeg() order
+        the variables dynamically.
+
+        value_order is a ValueOrder that orders the values tried for the
+        variable: ValueOrder() (the default) keeps the domain order,
+        LeastConstrainingValue() tries the least constraining values
+        first.
+
+        With backjumping, the search does conflict-directed backjumping
+        (CBJ).  Each assignment is first checked against the constraints
+        it shares with assigned variables.  The assigned variables of
+        the failing constraint whose latest variable was assigned
+        earliest (binary or global) are added to the conflict set of
+        the variable.  When a variable runs out of values, the search
+        jumps straight back to the most recent variable in its conflict
+        set instead of to the previous one.  Every value the checker
+        prunes is blamed on the assignment made last before it went,
+        when that assignment rules the value out by itself through a
+        binary constraint, and on that assignment and all earlier ones
+        otherwise (it went through propagation).  So the values pruned
+        from a variable before it is tried, and a domain the checker
+        wipes out, put only those assignments in the conflict set; any
+        other rejection by constraint_checker puts all earlier
+        variables in it.  The number of untried sibling nodes jumped
+        over is left in self.statistics['skipped'].
+
+        prefix is a sequence of values for the first variables of
+        variable_order.  The search then only covers the subtree below
+        that partial assignment: the root is the state with the prefix
+        assigned (checked one assignment at a time), as solve_parallel()
+        uses it.
+
+        returns the solution state, and the search tree (None when
+        record_tree is TREE_NONE).
+        """
+        for answer, tree in self._search(constraint_checker, verbose,
+                                         use_trail, record_tree,
+                                         variable_selector, value_order,
+                                         backjumping, prefix):
+            return answer, tree
+
+    def solve_iter(self,
+                   constraint_checker=basic_constraint_checker,
+                   limit=None,
+                   verbose=False,
+                   use_trail=False,
+                   variable_selector=None,
+                   value_order=None,
+                   backjumping=False,
+                   prefix=()):
+        """
+        Enumerate the solutions of this CSP problem, in the order solve()
+        finds them.  The search stops at each solution and resumes from
+        there when the next one is asked for, and no search tree is
+        kept, so memory stays bounded by the depth of the search however
+        many solutions are streamed.  At most limit solutions are
+        produced.  The other arguments are as for solve().
+
+        yields the solution() of every solution state.
+        """
+        if limit is not None and limit <= 0:
+            return
+        count = 0
+        for answer, tree in self._search(constraint_checker, verbose,
+                                         use_trail, CSP.TREE_NONE,
+                                         variable_selector, value_order,
+                                         backjumping, prefix):
+            if answer is None:
+                return
+            yield answer.solution()
+            count += 1
+            if count == limit:
+                return
+
+    def solve_optimal(self,
+                      objective,
+                      lower_bound=None,
+                      constraint_checker=basic_constraint_checker,
+                      verbose=False,
+                      use_trail=False,
+                      variable_selector=None,
+                      value_order=None,
+                      backjumping=False):
+        """
+        Find a solution of this CSP problem that minimizes objective, by
+        depth-first branch and bound.  objective takes a solution state
+        and returns its cost; to maximize, return the negated value.
+
+        lower_bound takes a partial state and returns a cost that no
+        solution below it can beat (it must never be more than the
+        objective of such a solution).  Once a solution is known, any
+        node whose lower bound is not below its cost is pruned like a
+        node the constraint checker rejects.  Without a lower bound,
+        every solution is visited.  The other arguments are as for
+        solve().
+
+        returns the best solution() (None if there is none) and the list
+        of (cost, solution()) pairs of the improving solutions in the
+        order they were found, the last one being the best.
+        """
+        # cost of the best solution so far; a list so the closure sees
+        # updates
+        incumbent = [None]
+
+        def bounded_checker(state, verbose=False):
+            if not constraint_checker(state, verbose):
+                return False
+            if lower_bound is None or incumbent[0] is None:
+                return True
+            if lower_bound(state) >= incumbent[0]:
+                if verbose:
+                    print "BOUND-FAILS: %s" %(incumbent[0])
+                return False
+            return True
+
+        improvements = []
+        for answer, tree in self._search(bounded_checker, verbose,
+                                         use_trail, CSP.TREE_NONE,
+                                         variable_selector, value_order,
+                                         backjumping, ()):
+            if answer is None:
+                break
+            cost = objective(answer)
+            if incumbent[0] is None or cost < incumbent[0]:
+                incumbent[0] = cost
+                improvements.append((cost, answer.solution()))
+                if verbose:
+                    print "IMPROVED: %s" %(cost)
+
+        if improvements:
+            return improvements[-1][1], improvements
+        return None, improvements
+
+    def repair(self,
+               previous,
+               constraint_checker=basic_constraint_checker,
+               max_changes=None,
+               verbose=False,
+               use_trail=False,
+               variable_selector=None,
+               value_order=None):
         """
-        initial_state = self.initial_state()
-        search_root = Node("ROOT", initial_state)
-        agenda = [search_root]
+        Find a solution of this CSP problem as close as possible to
+        previous, a solution() (or a dict) of an earlier version of the
+        problem: for example with a variable removed, domains narrowed
+        or constraints changed.
+
+        The search tries the old value of every variable first and is
+        limited to solutions that change at most k of the old values,
+        for k = 0, 1, ... up to max_changes (by default, all of them),
+        so the first solution found changes as few old values as
+        possible and only the neighbourhood of the old solution is
+        searched.  Old values of variables the problem no longer has
+        are ignored; variables without an old value are free.  The other
+        arguments are as for solve().
+
+        returns the new solution() and the names of the variables whose
+        value changed, or None, None.
+        """
+        previous = dict((name, value) for name, value in dict(previous).items()
+                        if name in self.variable_map)
+        if value_order is None:
+            value_order = ValueOrder()
+        order = _PreferredValueOrder(previous, value_order)
+
+        # old values that are no longer in their domain have to change
+        forced = 0
+        for name, value in previous.items():
+            if not self.variable_map[name].in_domain(value):
+                forced += 1
+        if max_changes is None:
+            max_changes = len(previous)
+
+        for limit in range(forced, max_changes + 1):
+            def limited_checker(state, verbose=False):
+                # count the old values that are changed, or have to be
+                # because they left the domain
+                changes = 0
+                keep = []
+                for name, value in previous.items():
+                    var = state.get_variable_by_name(name)
+                    if var.is_assigned():
+                        if var.get_assigned_value() != value:
+                            changes += 1
+                    elif not var.in_domain(value):
+                        changes += 1
+                    elif var.domain_size() > 1:
+                        keep.append((var, value))
+                if changes > limit:
+                    return False
+                if changes == limit:
+                    # no more changes allowed: the others keep their
+                    # old value
+                    for var, value in keep:
+                        _keep_only(var, value)
+                return constraint_checker(state, verbose)
 
-        step = 0
-        while len(agenda) > 0:
-            cur_node = agenda.pop(0)
-            state = cur_node.value
-            cur_node.step = step
+            if verbose:
+                print "REPAIR WITH AT MOST %d CHANGES" %(limit)
+            for answer, tree in self._search(limited_checker, verbose,
+                                             use_trail, CSP.TREE_NONE,
+                                             variable_selector, order,
+                                             False, ()):
+                if answer is not None:
+                    solution = answer.solution()
+                    changed = [name for name, value in solution
+                               if name in previous and previous[name] != value]
+                    return solution, changed
+                break
+        return None, None
+
+    def _search(self, constraint_checker, verbose, use_trail, record_tree,
+                variable_selector, value_order, backjumping, prefix):
+        """
+        The search behind solve() and solve_iter(): yields (solution
+        state, search tree) for every solution in turn, then (None,
+        search tree) once the whole tree has been searched.  In trail
+        mode a solution state is only valid until the search resumes.
+        """
+        keep_states = record_tree == CSP.TREE_FULL and not use_trail
+        link_nodes = record_tree != CSP.TREE_NONE
+
+        if variable_selector is None:
+            variable_selector = VariableSelector()
+        if value_order is None:
+            value_order = ValueOrder()
+
+        # work on a copy so that the search leaves the problem's own
+        # variables untouched
+        if use_trail:
+            initial_state = self.initial_state().trailed_copy()
+        else:
+            initial_state = self.initial_state().copy()
+        variable_selector.start(initial_state)
+        value_order.start(initial_state)
+        if keep_states:
+            search_root = Node("ROOT", initial_state)
+        else:
+            search_root = Node("ROOT", None)
+
+        self.statistics = {'examined': 0, 'failed': 0, 'max_depth': 0}
+        if backjumping:
+            self.statistics['skipped'] = 0
+            # from the start, so that it sees every pruning
+            initial_state.add_watcher(_Prunings, _Prunings(initial_state))
+        # counter shared with examine(); a list so the closure can bump it
+        step = [0]
+
+        def examine(node, state, conflicts=None, past=()):
+            """
+            Run the checker on a newly made node and label it with
+            the outcome.  When backjumping, the culprits of a failure are
+            added to conflicts; past are the variables assigned earlier.
+            """
+            node.step = step[0]
+            step[0] += 1
+            self.statistics['examined'] += 1
 
             if verbose:
                 print "-"*20
-                print "%d. EXAMINING:\n%s" %(step, state.vd_table())
+                print "%d. EXAMINING:\n%s" %(node.step, state.vd_table())
 
-            if not constraint_checker(state, verbose):
+            if conflicts is None:
+                failed = not constraint_checker(state, verbose)
+            else:
+                failed, culprits = _find_conflicts(state, past, verbose)
+                if not failed and not constraint_checker(state, verbose):
+                    failed = True
+                    culprits = state.get_watcher(_Prunings).wipe_out(state)
+                    if culprits is None:
+                        culprits = past
+                conflicts.update(culprits)
+                conflicts.discard(state.get_current_variable_name())
+                conflicts.difference_update(fixed)
+
+            if failed:
                 if verbose:
-                    print "%d. FAIL:\n%s" %(step, state.vd_table())
-                cur_node.status = Node.FAILED
-                step += 1
-                continue
-
-            if state.is_solution():
-                cur_node.status = Node.SOLUTION
+                    print "%d. FAIL:\n%s" %(node.step, state.vd_table())
+                node.status = Node.FAILED
+                self.statistics['failed'] += 1
+                variable_selector.failed(state)
+            elif state.is_solution():
+                node.status = Node.SOLUTION
                 if verbose:
-                    print "%d. SOLUTION:\n%s" %(step, state.vd_table())
-                return state, search_root
+                    print "%d. SOLUTION:\n%s" %(node.step, state.vd_table())
+            else:
+                node.status = Node.CONTINUE
+                if verbose:
+                    print "%d. CONTINUE:\n%s" %(node.step, state.vd_table())
+            return node.status
+
+        def expand(node, state):
+            """
+            Make the stack frame of a node whose children are still to
+            be generated: (node, state, next variable index, iterator
+            over the values of that variable, trail mark).
+            """
+            next_variable_index = variable_selector.select(state)
+            mark = None
+            if use_trail:
+                mark = state.mark()
+            return (node, state, next_variable_index,
+                    iter(value_order.order(state, next_variable_index)), mark)
+
+        if link_nodes:
+            tree = search_root
+        else:
+            tree = None
+
+        for variable_index, value in enumerate(prefix):
+            if variable_index > 0 and \
+                    not constraint_checker(initial_state, verbose):
+                yield None, tree
+                return
+            initial_state.set_variable_by_index(variable_index, value)
+        # the prefix is fixed, so it is never a culprit to jump back to
+        fixed = set(self.variable_order[:len(prefix)])
+
+        status = examine(search_root, initial_state)
+        if status == Node.SOLUTION:
+            yield initial_state, tree
+        if status != Node.CONTINUE:
+            yield None, tree
+            return
+
+        stack = [expand(search_root, initial_state)]
+        if backjumping:
+            # per stack frame: the name of the variable it assigns and
+            # its conflict set
+            assigned = []
+            conflict_sets = []
+            def push_conflict_set(state, variable_index):
+                assigned.append(state.variable_order[variable_index])
+                conflict_sets.append(set())
+            push_conflict_set(initial_state, stack[-1][2])
+
+        while stack:
+            node, state, variable_index, values, mark = stack[-1]
+            if use_trail:
+                # back out whatever the previous sibling's subtree did
+                state.undo(mark)
+
+            value = next(values, _NO_VALUE)
+            if value is _NO_VALUE:
+                stack.pop()
+                if not backjumping:
+                    continue
+                name = assigned.pop()
+                conflict_set = conflict_sets.pop()
+                # the values pruned before the variable was tried; the
+                # state is back to what it was then
+                conflict_set.update(
+                    state.get_watcher(_Prunings).explain(state, name))
+                conflict_set.difference_update(fixed)
+                if not conflict_set:
+                    # the failure does not depend on any assignment
+                    break
+                depths = dict((name, depth)
+                              for depth, name in enumerate(assigned))
+                target = max(depths[name] for name in conflict_set)
+                while len(stack) > target + 1:
+                    self.statistics['skipped'] += sum(1 for v in stack[-1][3])
+                    stack.pop()
+                    assigned.pop()
+                    conflict_sets.pop()
+                conflict_set.discard(assigned[target])
+                conflict_sets[target].update(conflict_set)
+                continue
 
-            cur_node.status = Node.CONTINUE
+            if use_trail:
+                child_state = state
+            else:
+                child_state = state.copy()
+            child_state.set_variable_by_index(variable_index, value)
+            if keep_states:
+                child = Node(str(value), child_state)
+            else:
+                child = Node(str(value), None,
+                             state.variable_order[variable_index])
+            if link_nodes:
+                node.add_children([child])
+            if len(stack) > self.statistics['max_depth']:
+                self.statistics['max_depth'] = len(stack)
+
+            if backjumping:
+                status = examine(child, child_state,
+                                 conflict_sets[-1], assigned[:-1])
+            else:
+                status = examine(child, child_state)
+            if status == Node.SOLUTION:
+                if backjumping:
+                    # the search goes on, and there is no telling which
+                    # earlier assignments this solution depends on
+                    conflict_sets[-1].update(assigned[:-1])
+                yield child_state, tree
+            if status == Node.CONTINUE:
+                stack.append(expand(child, child_state))
+                if backjumping:
+                    push_conflict_set(child_state, stack[-1][2])
+
+        # no (more) solutions
+        yield None, tree
+
+# marks the end of a domain iterator in CSP.solve
+_NO_VALUE = object()
+
+def _find_conflicts(state, past, verbose=False):
+    """
+    Check the constraints between the variable assigned last and the
+    other assigned variables.  Returns whether any of them fails and the
+    variables to blame, past being those assigned earlier in order: of
+    the failing constraints, the one whose latest culprit was assigned
+    earliest.  The culprits of a binary constraint are its other
+    variable; those of a global one are its other assigned variables,
+    and the ones the pruned values of its unassigned variables are
+    blamed on, as its check may count on their domains.
+    """
+    var_name = state.get_current_variable_name()
+    depths = dict((name, depth) for depth, name in enumerate(past))
+    failed = False
+    culprits = set()
+    latest = None
+    for constraint in state.get_incident_constraints(var_name):
+        others = [name for name in constraint.get_variable_names()
+                  if name != var_name and
+                  state.get_variable_by_name(name).is_assigned()]
+        if isinstance(constraint, BinaryConstraint) and not others and \
+                constraint.get_variable_i_name() != \
+                constraint.get_variable_j_name():
+            continue
+        if not constraint.check(state):
             if verbose:
-                print "%d. CONTINUE:\n%s" %(step, state.vd_table())
+                print "CONSTRAINT-FAILS: %s" %(constraint)
+            failed = True
+            blamed = set(others)
+            if not isinstance(constraint, BinaryConstraint):
+                prunings = state.get_watcher(_Prunings)
+                for name in constraint.get_variable_names():
+                    if not state.get_variable_by_name(name).is_assigned():
+                        blamed.update(prunings.explain(state, name))
+                blamed.discard(var_name)
+            depth = max([depths.get(name, -1) for name in blamed] or [-1])
+            if latest is None or depth < latest:
+                latest = depth
+                culprits = blamed
+    return failed, culprits
+
+class _Prunings(object):
+    """
+    State watcher of CSP.solve() when backjumping: remembers, for the
+    values pruned from every domain, the assignment made last before
+    they went (None before any), and the order of the assignments.
+    Pruned values come in groups, one per change of a domain: a mask
+    for a BitsetVariable, a frozenset of values otherwise.
+    """
+    def __init__(self, state=None):
+        # names of the assigned variables, in the order of assignment
+        self._order = []
+        self._assigned = set()
+        # var name -> its domain when last seen (a mask or a frozenset)
+        self._domains = {}
+        # var name -> tuple of (pruned values, culprit)
+        self._pruned = {}
+        if state is not None:
+            for variable in state.get_all_variables():
+                self._domains[variable.get_name()] = _domain_of(variable)
+                if variable.is_assigned():
+                    self._order.append(variable.get_name())
+                    self._assigned.add(variable.get_name())
 
+    def copy(self):
+        prunings = _Prunings()
+        prunings._order = self._order[:]
+        prunings._assigned = set(self._assigned)
+        # the values are never changed in place, so they are shared
+        prunings._domains = self._domains.copy()
+        prunings._pruned = self._pruned.copy()
+        return prunings
+
+    def variable_changed(self, variable):
+        name = variable.get_name()
+        if variable.is_assigned():
+            if name not in self._assigned:
+                self._assigned.add(name)
+                self._order.append(name)
+        elif name in self._assigned:
+            self._assigned.discard(name)
+            self._order.remove(name)
+
+        old = self._domains[name]
+        if isinstance(variable, BitsetVariable):
+            new = variable.get_mask()
+            if new == old:
+                return
+            removed = old & ~new
+            restored = new & ~old
+        else:
+            # plain domains only change one value at a time
+            if variable.domain_size() == len(old):
+                return
+            new = frozenset(variable.get_domain())
+            removed = old - new
+            restored = new - old
+        self._domains[name] = new
+
+        pruned = self._pruned.get(name, ())
+        if restored:
+            if pruned and pruned[-1][0] == restored:
+                # undone, the way backtracking does it
+                pruned = pruned[:-1]
+            else:
+                pruned = tuple((_without(values, restored), culprit)
+                               for values, culprit in pruned
+                               if _without(values, restored))
+        if removed:
+            culprit = None
+            if self._order:
+                culprit = self._order[-1]
+            pruned += ((removed, culprit),)
+        self._pruned[name] = pruned
+
+    def explain(self, state, name):
+        """
+        The assignments the values pruned from the domain of name are
+        blamed on: the culprit of a value when it rules the value out by
+        itself through a binary constraint, and the culprit and every
+        earlier assignment otherwise.
+        """
+        positions = dict((assigned, k)
+                         for k, assigned in enumerate(self._order))
+        variable = state.get_variable_by_name(name)
+        culprits = set()
+        # every assignment up to this position is to blame
+        covered = -1
+        for values, culprit in self._pruned.get(name, ()):
+            if culprit is None or positions[culprit] <= covered:
+                continue
+            if _rules_out(state, culprit, variable, values):
+                culprits.add(culprit)
+            else:
+                covered = positions[culprit]
+        culprits.update(self._order[:covered + 1])
+        return culprits
 
-            next_variable_index = state.variable_index + 1
-            next_variable = state.get_variable_by_index(next_variable_index)
-            values = next_variable.get_domain()
+    def wipe_out(self, state):
+        """
+        The assignments to blame for a domain left empty, or None if
+        there is none.
+        """
+        for variable in state.get_all_variables():
+            if not variable.is_assigned() and variable.domain_size() == 0:
+                return self.explain(state, variable.get_name())
+        return None
 
-            children = []
-            for value in values:
-                new_state = state.copy()
-                new_state.set_variable_by_index(next_variable_index, value)
-                children.append(Node(str(value), new_state))
+def _domain_of(variable):
+    if isinstance(variable, BitsetVariable):
+        return variable.get_mask()
+    return frozenset(variable.get_domain())
 
-            cur_node.add_children(children)
-            agenda = children + agenda
-            step += 1
+def _without(values, restored):
+    if isinstance(values, frozenset):
+        return values - restored
+    return values & ~restored
 
-        # fail! no solution
-        return None, search_root
+def _rules_out(state, culprit, variable, values):
+    """
+    Whether the value of the assigned variable culprit rules out each
+    of values (a mask or a frozenset) for variable through some binary
+    constraint between the two.
+    """
+    name = variable.get_name()
+    constraints = [constraint
+                   for constraint in state.get_incident_constraints(name)
+                   if isinstance(constraint, BinaryConstraint) and
+                   culprit in constraint.get_variable_names()]
+    if not constraints:
+        return False
+    if not isinstance(values, frozenset):
+        table = variable.get_value_table()
+        mask = values
+        values = []
+        while mask:
+            low = mask & -mask
+            values.append(table[low.bit_length() - 1])
+            mask ^= low
+    value = state.get_variable_by_name(culprit).get_assigned_value()
+    for v in values:
+        for constraint in constraints:
+            if constraint.get_variable_i_name() == name:
+                allowed = constraint.check(state, v, value)
+            else:
+                allowed = constraint.check(state, value, v)
+            if not allowed:
+                break
+        else:
+            return False
+    return True
 
 class Node:
     """
@@ -392,22 +1943,35 @@ class Node:
     CONTINUE = "c"
     SOLUTION = "*"
 
-    def __init__(self, label, value):
+    def __init__(self, label, value, variable_name=None):
+        """
+        value is the CSPState of the node.  Nodes that do not keep a
+        state of their own give the name of the variable they assign.
+        """
         self.label = label
         self.status = Node.UNEXTENDED
         self.value = value
+        self.variable_name = variable_name
         self.step = '-'
         self.children = []
 
     def add_children(self, children):
         self.children += children
 
+    def get_variable_name(self):
+        """
+        Name of the variable assigned at this node, None at the root.
+        """
+        if self.variable_name is not None or self.value is None:
+            return self.variable_name
+        return self.value.get_current_variable_name()
+
     def __str__(self):
         return self.label
 
     def tree_to_string(self, node, depth=0):
         pad = depth*"\t"
-        current_var = node.value.get_current_variable_name()
+        current_var = node.get_variable_name()
         if current_var is not None:
             buf = "%s%s=%s(%s,%s)\n" %(pad,
                                        current_var,
@@ -474,6 +2038,203 @@ def solve_csp_problem(problem, checker, verbose=False):
 
     return answer, search_tree
 
+import itertools
+import multiprocessing
+
+def _solve_configuration(job):
+    """
+    Runs one configuration of a portfolio in a worker process.  Only
+    the solution goes back, as the answer state refers to the
+    constraint functions.
+    """
+    index, problem, checker, variable_selector, value_order = job
+    csp = problem()
+    answer, search_tree = csp.solve(checker,
+                                    record_tree=CSP.TREE_NONE,
+                                    variable_selector=variable_selector,
+                                    value_order=value_order)
+    if answer is None:
+        return index, None, csp.statistics
+    return index, answer.solution(), csp.statistics
+
+def solve_portfolio(problem, checkers=None, variable_selectors=(None,),
+                    value_orders=(None,), seeds=(), processes=None,
+                    timeout=None, verbose=False):
+    """
+    Solve the problem with several configurations at once and keep the
+    one that finishes first.
+
+    problem is a function that returns a CSP object that we can solve;
+    like the checkers, selectors and value orders it is sent to worker
+    processes, so it must be picklable (a module-level function).
+    The value orders are value_orders plus a RandomValueOrder for each
+    of the seeds, and every combination of a checker, a variable
+    selector and one of those value orders is a configuration (so each
+    seed adds len(checkers) x len(variable_selectors) of them).  The
+    configurations run in a pool of processes
+    workers (one per core by default); as soon as one of them finds a
+    solution, or proves that there is none, the others are terminated.
+    Each configuration is a complete search, so the first one to finish
+    is right either way.
+
+    returns (solution, configuration), where solution is the
+    answer.solution() of the winner or None, and configuration is its
+    (checker, variable_selector, value_order) tuple.  Both are None if
+    nothing finished within timeout seconds.
+    """
+    if checkers is None:
+        import lab4
+        checkers = [basic_constraint_checker,
+                    lab4.forward_checking,
+                    lab4.forward_checking_prop_singleton]
+    orders = list(value_orders) + [RandomValueOrder(seed) for seed in seeds]
+    configurations = list(itertools.product(checkers, variable_selectors,
+                                            orders))
+    jobs = [(index, problem) + configuration
+            for index, configuration in enumerate(configurations)]
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(min(processes, len(jobs)))
+    try:
+        results = pool.imap_unordered(_solve_configuration, jobs)
+        try:
+            index, solution, statistics = results.next(timeout)
+        except multiprocessing.TimeoutError:
+            index, solution, statistics = None, None, None
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if index is None:
+        configuration = None
+    else:
+        configuration = configurations[index]
+
+    if verbose:
+        if configuration is None:
+            print "NO CONFIGURATION FINISHED"
+        else:
+            print "WINNER: %s %s" %(configuration, statistics)
+            if solution is not None:
+                print "ANSWER: %s" %(solution)
+            else:
+                print "NO SOLUTION FOUND"
+
+    return solution, configuration
+
+# the problem and checker of a solve_parallel() worker process, set
+# once by its initializer
+_subtree_worker = {}
+
+def _init_subtree_worker(problem, checker):
+    _subtree_worker['csp'] = problem()
+    _subtree_worker['checker'] = checker
+
+def _solve_subtree(task):
+    """
+    Look for the first solution below the prefix of a task.
+    """
+    index, prefix = task
+    csp = _subtree_worker['csp']
+    answer, search_tree = csp.solve(_subtree_worker['checker'],
+                                    record_tree=CSP.TREE_NONE,
+                                    prefix=prefix)
+    if answer is None:
+        return index, None
+    return index, answer.solution()
+
+def _enumerate_subtree(task):
+    """
+    List all the solutions below the prefix of a task.
+    """
+    index, prefix = task
+    csp = _subtree_worker['csp']
+    return index, list(csp.solve_iter(_subtree_worker['checker'],
+                                      prefix=prefix))
+
+def _split(csp, checker, tasks):
+    """
+    Assign the first variables of variable_order breadth first, keeping
+    the partial assignments that pass the checker, until there are at
+    least tasks of them (or only one variable is left).  Returns their
+    values, in the order a depth-first search would reach them.
+    """
+    initial_state = csp.initial_state().copy()
+    if not checker(initial_state, False):
+        return []
+    frontier = [((), initial_state)]
+    depth = 0
+    while len(frontier) < tasks and depth < len(csp.variable_order) - 1:
+        next_frontier = []
+        for prefix, state in frontier:
+            variable = state.get_variable_by_index(depth)
+            for value in variable.get_domain():
+                child_state = state.copy()
+                child_state.set_variable_by_index(depth, value)
+                if checker(child_state, False):
+                    next_frontier.append((prefix + (value,), child_state))
+        frontier = next_frontier
+        depth += 1
+    return [prefix for prefix, state in frontier]
+
+def solve_parallel(problem, checker=basic_constraint_checker,
+                   processes=None, tasks_per_process=8,
+                   all_solutions=False, verbose=False):
+    """
+    Solve the problem in a pool of worker processes by splitting the
+    search tree into the subtrees below partial assignments of the
+    first variables of variable_order.
+
+    problem is a function that returns a CSP object that we can solve;
+    it and the checker must be picklable (module-level functions).
+    They are sent once to each worker, which builds its own copy of the
+    problem, so a task is only the tuple of values of its prefix.
+    About tasks_per_process subtrees are made per worker and handed out
+    one at a time, so a worker that is done with a small subtree takes
+    the next unexplored one while others are still busy with big ones.
+
+    returns the first solution found (an answer.solution() list), or
+    None; with all_solutions, the list of all solutions instead, in the
+    order CSP.solve() would find them.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    prefixes = _split(problem(), checker, processes * tasks_per_process)
+    tasks = list(enumerate(prefixes))
+    if verbose:
+        print "SUBTREES: %d" %(len(tasks))
+    if not tasks:
+        if all_solutions:
+            return []
+        return None
+
+    pool = multiprocessing.Pool(min(processes, len(tasks)),
+                                _init_subtree_worker, (problem, checker))
+    try:
+        if all_solutions:
+            found = dict(pool.imap_unordered(_enumerate_subtree, tasks))
+            result = [solution for index in range(len(tasks))
+                      for solution in found[index]]
+        else:
+            result = None
+            for index, solution in pool.imap_unordered(_solve_subtree, tasks):
+                if solution is not None:
+                    result = solution
+                    break
+    finally:
+        pool.terminate()
+        pool.join()
+
+    if verbose:
+        if all_solutions:
+            print "SOLUTIONS: %d" %(len(result))
+        elif result is not None:
+            print "ANSWER: %s" %(result)
+        else:
+            print "NO SOLUTION FOUND"
+    return result
+
 if __name__ == "__main__":
     checker = basic_constraint_checker
     import lab4
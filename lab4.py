@@ -1,5 +1,6 @@
 #from classify import *
 import math
+from collections import deque
 
 ##
 ## CSP portion of lab 4.
@@ -32,8 +33,17 @@ def forward_checking(state, verbose=False):
         # ROOT
         return True
 
+    curr_value = state.get_current_variable().get_assigned_value()
     for constraint in state.get_constraints_by_name(curr_var_name):
         var_j = state.get_variable_by_name( constraint.get_variable_j_name() )
+        table = constraint.table
+        if table is not None and table.filters_j(var_j) and \
+                table.row(curr_value) is not None:
+            # compiled constraint: keep the supported values in one go
+            if var_j.intersect_mask(table.row(curr_value)) == 0:
+                return False
+            continue
+
         for val in var_j.get_domain():
             if not constraint.check(state, value_i = None, value_j = val):
                 var_j.reduce_domain(val)
@@ -52,11 +62,11 @@ def forward_checking_prop_singleton(state, verbose=False):
         return False
 
     # Add your propagate singleton logic here.
-    singleton_queue = [ var for var in state.get_all_variables() if var.domain_size() == 1 ]
+    singleton_queue = deque([ var for var in state.get_all_variables() if var.domain_size() == 1 ])
     visited_singletons = set([])
 
     while singleton_queue:
-        var = singleton_queue.pop(0)
+        var = singleton_queue.popleft()
 
         visited_singletons.add(var)
         for constraint in state.get_constraints_by_name(var.get_name()):
@@ -73,5 +83,180 @@ def forward_checking_prop_singleton(state, verbose=False):
 
     return True
 
+# Arc consistency (AC-3 queue with AC-2001 last supports).
+#
+# An arc (constraint, forward) revises variable i of the constraint against
+# variable j when forward is true, and j against i otherwise.  A binary
+# constraint on a single variable (i == j) is revised as a unary constraint.
+# An assigned variable counts as having the single value it is assigned;
+# its domain is never reduced, a value left without support fails the check.
+def _arc_variables(constraint, forward):
+    if forward:
+        return constraint.get_variable_i_name(), constraint.get_variable_j_name()
+    return constraint.get_variable_j_name(), constraint.get_variable_i_name()
+
+def _arcs_into(state, var_name):
+    """
+    The arcs that revise the neighbours of var_name against it.
+    """
+    arcs = []
+    for constraint in state.get_incident_constraints(var_name):
+        if not isinstance(constraint, BinaryConstraint):
+            continue
+        if constraint.get_variable_j_name() == var_name:
+            arcs.append((constraint, True))
+        if constraint.get_variable_i_name() == var_name:
+            arcs.append((constraint, False))
+    return arcs
+
+def _supports(state, constraint, forward, x, y):
+    if forward:
+        return constraint.check(state, x, y)
+    return constraint.check(state, y, x)
+
+def _propagate_arcs(state, arcs, verbose=False):
+    """
+    Revise arcs until the queue is empty, putting back the arcs into
+    every variable whose domain was reduced.  Returns False on a domain
+    wipe-out.
+    """
+    # per call, the values of each variable in a fixed order (the
+    # positions the last supports refer to) and the ones still alive
+    tables = {}
+    alive = {}
+    def values_of(name):
+        if name not in tables:
+            var = state.get_variable_by_name(name)
+            if var.is_assigned():
+                tables[name] = [var.get_assigned_value()]
+            else:
+                tables[name] = var.get_domain()
+            alive[name] = set(tables[name])
+        return tables[name]
+
+    # (constraint, forward, x) -> position in the table of the other
+    # variable of its last found support
+    last = {}
+    queue = deque(arcs)
+    queued = set(arcs)
+    while queue:
+        arc = queue.popleft()
+        queued.discard(arc)
+        constraint, forward = arc
+        x_name, y_name = _arc_variables(constraint, forward)
+        x_var = state.get_variable_by_name(x_name)
+
+        removed = False
+        for x in values_of(x_name):
+            if x not in alive[x_name]:
+                continue
+            if x_name == y_name:
+                supported = _supports(state, constraint, forward, x, x)
+            else:
+                y_table = values_of(y_name)
+                y_alive = alive[y_name]
+                key = (constraint, forward, x)
+                position = last.get(key)
+                if position is not None and y_table[position] in y_alive:
+                    continue
+                supported = False
+                start = position + 1 if position is not None else 0
+                for position in xrange(start, len(y_table)):
+                    y = y_table[position]
+                    if y in y_alive and _supports(state, constraint, forward, x, y):
+                        last[key] = position
+                        supported = True
+                        break
+            if supported:
+                continue
+
+            if x_var.is_assigned():
+                if verbose:
+                    print "CONSTRAINT-FAILS: %s" %(constraint)
+                return False
+            alive[x_name].discard(x)
+            x_var.reduce_domain(x)
+            removed = True
+            if x_var.domain_size() == 0:
+                if verbose:
+                    print "DOMAIN-WIPEOUT: %s by %s" %(x_name, constraint)
+                return False
+
+        if removed:
+            for next_arc in _arcs_into(state, x_name):
+                if next_arc not in queued:
+                    queue.append(next_arc)
+                    queued.add(next_arc)
+    return True
+
+def make_arc_consistent(state, verbose=False):
+    """
+    Reduce the domains of state until every arc of every binary
+    constraint is consistent.  Returns False if some domain is wiped out.
+
+    The initial state of a CSP shares the problem's variables, so
+    make_arc_consistent(csp.initial_state()) can be run as a
+    preprocessing pass before csp.solve().
+    """
+    arcs = []
+    for constraint in state.get_all_constraints():
+        if isinstance(constraint, BinaryConstraint):
+            arcs.append((constraint, True))
+            arcs.append((constraint, False))
+    return _propagate_arcs(state, arcs, verbose)
+
+def arc_consistency(state, verbose=False):
+    """
+    Maintaining arc consistency (MAC) checker for CSP.solve().  At the
+    root it makes the whole problem arc consistent, after an assignment
+    it propagates from the variable just assigned through every arc
+    whose domain shrinks.  Prunes at least as much as
+    forward_checking_prop_singleton.
+    """
+    basic = basic_constraint_checker(state, verbose)
+    if not basic:
+        return False
+
+    curr_var_name = state.get_current_variable_name()
+    if not curr_var_name:
+        # ROOT
+        return make_arc_consistent(state, verbose)
+
+    return _propagate_arcs(state, _arcs_into(state, curr_var_name), verbose)
+
+def _queens_problem(n):
+    """
+    n queens on an n x n board, one variable per column.
+    """
+    def no_attack(row_a, row_b, name_a, name_b):
+        distance = abs(int(name_a[1:]) - int(name_b[1:]))
+        return row_a != row_b and abs(row_a - row_b) != distance
+
+    variables = [Variable("Q%d" %(i), range(n)) for i in range(n)]
+    constraints = [BinaryConstraint("Q%d" %(i), "Q%d" %(j), no_attack)
+                   for i in range(n) for j in range(n) if i != j]
+    return CSP(constraints, variables)
+
+if __name__ == '__main__':
+    ## test make_arc_consistent() as a preprocessing pass
+    assert not make_arc_consistent(_queens_problem(3).initial_state())
+    assert make_arc_consistent(_queens_problem(4).initial_state())
+
+    ## test arc_consistency() against forward checking: the same first
+    ## solution, in fewer examined nodes
+    for n, counts in [(8, [89, 49, 21]), (12, [194, 98, 42])]:
+        examined = []
+        solutions = []
+        for checker in [forward_checking, forward_checking_prop_singleton,
+                        arc_consistency]:
+            problem = _queens_problem(n)
+            answer, search_tree = problem.solve(checker,
+                                                record_tree=CSP.TREE_NONE)
+            examined.append(problem.statistics['examined'])
+            solutions.append(answer.solution())
+        print "%d-queens examined: %s" %(n, examined)
+        assert counts == examined
+        assert solutions[0] == solutions[1] == solutions[2]
+
 ## The code here are for the tester
 ## Do not change.
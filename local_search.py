@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+Local search for the CSP problems of csp.py: min-conflicts hill climbing
+with a tabu list and random restarts.  It works on the same CSP (and
+SS_CSP) objects as CSP.solve(), on a state in which every variable is
+assigned.
+
+The violation of every constraint is kept and, after a move, only the
+constraints of the variable that moved are evaluated again, so a move
+costs O(degree) constraint evaluations.  A constraint with a
+violation(state) method reports how badly it is violated (for example
+CoverageConstraint, by how many staff every shift is off); any other
+constraint counts 1 when its check() fails.
+"""
+import random
+
+def violation(constraint, state):
+    """
+    How badly constraint is violated in a state where all its variables
+    are assigned; 0 when it holds.
+    """
+    if hasattr(constraint, 'violation'):
+        return constraint.violation(state)
+    if constraint.check(state):
+        return 0
+    return 1
+
+def _random_value(variable, rng):
+    if hasattr(variable, 'random_value'):
+        return variable.random_value(rng)
+    return rng.choice(list(variable.get_domain()))
+
+def _candidates(variable, rng, max_candidates):
+    """
+    The values to consider moving variable to: its whole domain, or a
+    sample of max_candidates of them when the domain is bigger.
+    """
+    size = variable.domain_size()
+    if max_candidates is None or size <= max_candidates:
+        return list(variable.get_domain())
+    if hasattr(variable, 'value_at'):
+        return [variable.value_at(k)
+                for k in rng.sample(xrange(size), max_candidates)]
+    return rng.sample(list(variable.get_domain()), max_candidates)
+
+class _Violations(object):
+    """
+    Violation of every constraint of a complete assignment, with their
+    total and the set of violated constraints.
+    """
+    def __init__(self, state):
+        self._state = state
+        self.violations = {}
+        self.violated = set()
+        self.total = 0
+        # constraint -> its position in get_all_constraints(), so that
+        # picking a violated one does not depend on hashing by id()
+        self._positions = {}
+        for position, constraint in enumerate(state.get_all_constraints()):
+            self._positions[constraint] = position
+            self._set(constraint, violation(constraint, state))
+
+    def violated_in_order(self):
+        """
+        The violated constraints, in the order of get_all_constraints().
+        """
+        return sorted(self.violated, key=self._positions.get)
+
+    def _set(self, constraint, amount):
+        self.total += amount - self.violations.get(constraint, 0)
+        self.violations[constraint] = amount
+        if amount:
+            self.violated.add(constraint)
+        else:
+            self.violated.discard(constraint)
+
+    def move_delta(self, variable, value):
+        """
+        Change of the total violation if variable moved to value.
+        The variable is left at value.
+        """
+        variable.set_value(value)
+        delta = 0
+        state = self._state
+        for constraint in state.get_incident_constraints(variable.get_name()):
+            delta += violation(constraint, state) - self.violations[constraint]
+        return delta
+
+    def move(self, variable, value):
+        variable.set_value(value)
+        state = self._state
+        for constraint in state.get_incident_constraints(variable.get_name()):
+            self._set(constraint, violation(constraint, state))
+
+def min_conflicts(csp, max_steps=10000, restarts=10, tabu_tenure=10,
+                  max_candidates=None, seed=None, verbose=False):
+    """
+    Look for a solution of csp by min-conflicts local search.
+
+    Every variable starts with a random value of its domain.  Each step
+    picks a random violated constraint and one of its variables at
+    random, and moves that variable to the value that lowers the total
+    violation most (ties are broken at random), even when that makes
+    things worse.  A variable does not go back to a value it left in
+    the last tabu_tenure steps, unless that gives the best total seen
+    so far.  Values are drawn from the variable's domain, so it should
+    hold the unary constraints.  With max_candidates, only a random
+    sample of that many values is tried in big domains.
+
+    After max_steps steps without a solution the search restarts from a
+    new random assignment, up to restarts times.  Counts of the search
+    are left in csp.statistics.
+
+    returns the solution() of the solution found, or None.
+    """
+    rng = random.Random(seed)
+    csp.statistics = {'steps': 0, 'restarts': 0, 'best_violation': None}
+
+    for restart in xrange(0, restarts + 1):
+        if restart:
+            csp.statistics['restarts'] += 1
+        state = csp.initial_state().copy()
+        variables = state.get_all_variables()
+        if any(variable.domain_size() == 0 for variable in variables):
+            return None
+        for variable in variables:
+            variable.set_value(_random_value(variable, rng))
+        violations = _Violations(state)
+        best = violations.total
+        # (variable name, value) -> the step until which it is tabu
+        tabu = {}
+
+        for step in xrange(0, max_steps):
+            if not violations.total:
+                break
+            csp.statistics['steps'] += 1
+            constraint = rng.choice(violations.violated_in_order())
+            name = rng.choice(list(constraint.get_variable_names()))
+            variable = state.get_variable_by_name(name)
+            current = variable.get_assigned_value()
+
+            best_delta = None
+            best_values = []
+            for value in _candidates(variable, rng, max_candidates):
+                if value == current:
+                    continue
+                delta = violations.move_delta(variable, value)
+                if tabu.get((name, value), -1) >= step and \
+                        violations.total + delta >= best:
+                    continue
+                if best_delta is None or delta < best_delta:
+                    best_delta = delta
+                    best_values = [value]
+                elif delta == best_delta:
+                    best_values.append(value)
+            variable.set_value(current)
+            if not best_values:
+                continue
+
+            tabu[(name, current)] = step + tabu_tenure
+            violations.move(variable, rng.choice(best_values))
+            if violations.total < best:
+                best = violations.total
+            if verbose:
+                print "%d. %s: violation %d" %(step, name, violations.total)
+
+        if csp.statistics['best_violation'] is None or \
+                best < csp.statistics['best_violation']:
+            csp.statistics['best_violation'] = best
+        if not violations.total:
+            return state.solution()
+    return None
@@ -35,6 +35,7 @@ for w in g_weekdays:
 #print "shift names: %s " % g_shift_names
 
 import itertools
+import random
 John = ('John', 'Manager')
 Joe = ('Joe', 'Manager')
 Billy = ('Billy', 'Manager')
@@ -60,9 +61,62 @@ managers = [John, Joe, Billy, Bob, Christina]
 sales = [AA, BB, CC, DD, EE, FF, GG, HH, KK]
 
 
-class Shift(Variable):
+def _binomial(n, k):
+    """
+    Number of k-combinations of n items.
+    """
+    if k < 0 or k > n:
+        return 0
+    k = min(k, n - k)
+    result = 1
+    for i in range(k):
+        result = result * (n - i) // (i + 1)
+    return result
+
+def _unrank_combination(pool, k, rank):
+    """
+    The rank-th k-combination of pool, in itertools.combinations order.
+    """
+    combination = []
+    n = len(pool)
+    position = 0
+    while k:
+        # number of combinations that start with pool[position]
+        count = _binomial(n - position - 1, k - 1)
+        if rank < count:
+            combination.append(pool[position])
+            k -= 1
+        else:
+            rank -= count
+        position += 1
+    return tuple(combination)
+
+def _rank_combination(pool, combination):
     """
+    Rank of combination among the len(combination)-combinations of
+    pool, in itertools.combinations order.
+    """
+    n = len(pool)
+    k = len(combination)
+    rank = 0
+    previous = -1
+    for t, member in enumerate(combination):
+        position = pool.index(member)
+        for skipped in range(previous + 1, position):
+            rank += _binomial(n - skipped - 1, k - t - 1)
+        previous = position
+    return rank
 
+class Shift(Variable):
+    """
+    A shift whose values are the teams of manager_num managers and
+    sales_num sales staff that can be picked from the employees in its
+    domain.  The teams are never stored: the domain is the product
+    C(managers, manager_num) x C(sales, sales_num) of the two pools,
+    less the teams that have been removed one by one, and teams are
+    ranked and unranked in the order itertools would generate them.
+    Removing an employee shrinks a pool, so the domain stays small to
+    represent however many teams it stands for.
     """
     def __init__(self, name, domain, manager_num=1, sales_num=3, value=None):
         """
@@ -70,58 +124,146 @@ class Shift(Variable):
         """
         self._manager_num = manager_num
         self._sales_num = sales_num
-        self._domain_value_generator = None
         super(Shift, self).__init__(name, domain, value)
+        self._managers = []
+        self._sales = []
+        for employee in self._domain:
+            employee_name, title = employee
+            if title == 'Manager':
+                self._managers.append(employee)
+            elif title == 'Sales':
+                self._sales.append(employee)
+            else:
+                raise Exception("Unknown title: %s for %s" % (title, employee_name))
+        # teams removed from the domain by reduce_domain()
+        self._excluded = set()
 
     def copy(self):
         """
         override
         """
-        return Shift(self._name, self._domain, self._manager_num, self._sales_num, self._value)
+        shift = Shift(self._name, self._managers + self._sales,
+                      self._manager_num, self._sales_num, self._value)
+        shift._excluded = set(self._excluded)
+        return shift
 
     def get_domain(self):
         """
-        override
+        override: an iterator over the teams, in rank order.
         """
-        if not self._domain_value_generator:
-            self._domain_value_generator = self._f()
-        return self._domain_value_generator()
+        excluded = self._excluded
+        for m in itertools.combinations(self._managers, self._manager_num):
+            for s in itertools.combinations(self._sales, self._sales_num):
+                team = m + s
+                if team not in excluded:
+                    yield team
 
     def reduce_domain(self, domain_value):
         """
-        override
+        override: domain_value is either an employee, who is taken out
+        of the pools, or a team, which is taken out of the domain.
         """
-        self._domain.remove(domain_value)
-        self._domain_value_generator = None
+        for pool in (self._managers, self._sales):
+            if domain_value in pool:
+                index = pool.index(domain_value)
+                del pool[index]
+                if self._trail is not None:
+                    self._trail.record(self._restore_employee,
+                                       pool, index, domain_value)
+                self._changed()
+                return
+
+        if not self.in_domain(domain_value):
+            raise ValueError("%s is not in the domain of %s"
+                             % (domain_value, self._name))
+        self._excluded.add(domain_value)
+        if self._trail is not None:
+            self._trail.record(self._restore_team, domain_value)
+        self._changed()
+
+    def _restore_employee(self, pool, index, employee):
+        pool.insert(index, employee)
+        self._changed()
+
+    def _restore_team(self, team):
+        self._excluded.discard(team)
+        self._changed()
+
+    def _team_count(self):
+        return _binomial(len(self._managers), self._manager_num) * \
+            _binomial(len(self._sales), self._sales_num)
+
+    def _excluded_ranks(self):
+        return sorted(self.index_of(team, True) for team in self._excluded
+                      if self._is_team(team))
+
+    def _is_team(self, team):
+        m = self._manager_num
+        return len(team) == m + self._sales_num and \
+            all(e in self._managers for e in team[:m]) and \
+            all(e in self._sales for e in team[m:]) and \
+            list(team[:m]) == sorted(team[:m], key=self._managers.index) and \
+            list(team[m:]) == sorted(team[m:], key=self._sales.index) and \
+            len(set(team)) == len(team)
+
+    def in_domain(self, team):
+        return self._is_team(team) and team not in self._excluded
 
     def domain_size(self):
         """
         override
         """
-        if not self._domain_value_generator:
-            self._domain_value_generator = self._f()
-        return len( list( self._domain_value_generator() ))
-
-    def _f(self):
-        def _f_1():
-            managers = []
-            sales = []
-            for name, title in self._domain:
-                if title == 'Manager':
-                    managers.append((name, title,))
-                elif title == 'Sales':
-                    sales.append((name, title,))
-                else:
-                    raise Exception('Unknown title: %s for %s' % (title, name))
-            manager_iter = itertools.combinations( managers, self._manager_num )
-            sales_iter = itertools.combinations( sales, self._sales_num )
-
-            for m in manager_iter:
-                for s in sales_iter:
-                    print 'yielding'
-                    yield m + s
-
-        return _f_1
+        excluded = sum(1 for team in self._excluded if self._is_team(team))
+        return self._team_count() - excluded
+
+    def index_of(self, team, ignore_excluded=False):
+        """
+        Position of team in get_domain().
+        """
+        if not self._is_team(team):
+            raise ValueError("%s is not in the domain of %s"
+                             % (team, self._name))
+        m = self._manager_num
+        rank = _rank_combination(self._managers, team[:m]) * \
+            _binomial(len(self._sales), self._sales_num) + \
+            _rank_combination(self._sales, team[m:])
+        if ignore_excluded:
+            return rank
+        if team in self._excluded:
+            raise ValueError("%s is not in the domain of %s"
+                             % (team, self._name))
+        return rank - sum(1 for r in self._excluded_ranks() if r < rank)
+
+    def value_at(self, index):
+        """
+        The team at position index of get_domain().
+        """
+        if index < 0 or index >= self.domain_size():
+            raise IndexError("%s has no value at %d" % (self._name, index))
+        for rank in self._excluded_ranks():
+            if rank <= index:
+                index += 1
+        sales_count = _binomial(len(self._sales), self._sales_num)
+        manager_rank, sales_rank = divmod(index, sales_count)
+        return _unrank_combination(self._managers, self._manager_num,
+                                   manager_rank) + \
+            _unrank_combination(self._sales, self._sales_num, sales_rank)
+
+    def random_value(self, rng=random):
+        """
+        A team picked uniformly from the domain.
+        """
+        size = self.domain_size()
+        if size == 0:
+            raise IndexError("%s has an empty domain" % self._name)
+        return self.value_at(rng.randrange(size))
+
+    def __str__(self):
+        buf = "%s(%s x %s: %d)" % (self._name, self._managers, self._sales,
+                                   self.domain_size())
+        if self._value is not None:
+            buf += ": %s" % (self._value,)
+        return buf
 
 class Employee(object):
     def __init__(self, name, title):
@@ -148,17 +290,16 @@ def shifts_csv_problem():
         return len(val_a) <= 4 and len(val_a) >= 2
 
     for n in g_shift_names:
-        constraints.append(BinaryConstraint(n, n, length_limit, "1 <= len(%s) <= 3" %n))
+        constraints.append(BinaryConstraint(n, n, length_limit, "1 <= len(%s) <= 3" %n, pure=True))
 
     def no_consecutive_shifts(val_a, val_b, name_a=None, name_b=None):
-        print "no_consecutive_shifts: %s, %s" %(val_a, val_b)
         return set(val_a).isdisjoint(set(val_b))
 
     s_names = g_shift_names
     while len(s_names) > 1:
         n1, n2 = tuple(s_names[:2])
         print n1 + "-" + n2
-        constraints.append(BinaryConstraint(n1, n2, no_consecutive_shifts, "No employee should be on two consecutive shifts: (%s) and (%s)" % (n1, n2)))
+        constraints.append(BinaryConstraint(n1, n2, no_consecutive_shifts, "No employee should be on two consecutive shifts: (%s) and (%s)" % (n1, n2), pure=True))
         s_names.pop(0)
 
     return CSP(constraints, variables)
@@ -1,24 +1,91 @@
 from csp import *
+import bisect
+import hashlib
+import inspect
+import itertools
+import local_search
+import mmap
+import os
+import random
+import struct
+import sys
+import types
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 weight_by_title = {'Manager': 100, 'Sales': 1}
 
-class Employee(Variable):
+class Employee(BitsetVariable):
+    """
+    An employee whose value is a weekly pattern of 21 shifts, weighted
+    by title.  The domain is kept as a bitset over the weighted patterns
+    since it holds thousands of them.
+    """
     def __init__(self, name, title, domain, value=None):
-        self._name = name
         self._title = title
-        self._value = value
-        self._domain = self._weight(domain)
+        weight = weight_by_title[title]
+        if getattr(domain, 'weight', None) != weight:
+            domain = weighted_patterns(domain, weight)
+        # already weighted: share the table instead of copying it
+        super(Employee, self).__init__(name, domain, value,
+                                       positions=domain.positions)
 
     def get_title(self):
         return self._title
 
-    def _weight(self, domain):
-        new_domain = set([])
-        weight = weight_by_title[self._title]
-        for d in domain:
-            weighted = tuple(map(lambda x: x * weight, d))
-            new_domain.add( weighted )
-        return list(new_domain)
+class WeightedPatterns(object):
+    """
+    The distinct patterns of a domain with every shift multiplied by
+    weight, and their positions.  Employees whose title has that weight
+    share it as their value table, like a PatternTable.
+    """
+    def __init__(self, patterns, weight):
+        self.weight = weight
+        self._patterns = tuple(patterns)
+        self.positions = dict((pattern, k)
+                              for k, pattern in enumerate(self._patterns))
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def __getitem__(self, index):
+        return self._patterns[index]
+
+    def __iter__(self):
+        return iter(self._patterns)
+
+def weighted_patterns(domain, weight):
+    """
+    The WeightedPatterns of domain (patterns of 0/1, or of staff for
+    another weight) for weight.  An array domain is deduplicated and
+    weighted in numpy.  Make it once per title and hand it to all the
+    employees of that title (see employees()).
+    """
+    if getattr(domain, 'weight', None) is not None:
+        # weighted for another title
+        domain = [tuple(1 if staff else 0 for staff in d) for d in domain]
+    if numpy is not None and isinstance(domain, numpy.ndarray):
+        unique = numpy.unique(domain, axis=0).astype(numpy.int64) * weight
+        return WeightedPatterns(map(tuple, unique.tolist()), weight)
+    weighted = set(tuple(staff * weight for staff in d) for d in domain)
+    return WeightedPatterns(weighted, weight)
+
+def employees(staff, domain):
+    """
+    An Employee per (name, title) of staff over domain, weighting the
+    domain once per title.
+    """
+    by_title = {}
+    variables = []
+    for name, title in staff:
+        if title not in by_title:
+            by_title[title] = weighted_patterns(domain,
+                                                weight_by_title[title])
+        variables.append(Employee(name, title, by_title[title]))
+    return variables
 
 def initial_domain(pre_condition=[]):
     """
@@ -26,7 +93,27 @@ def initial_domain(pre_condition=[]):
     The total number of all possibilities for each employee is thus 2 to the 21st power. However, the majority of the
     possibilities are impratical. In practice, the most basic and the most important assumption is that one employee
     only works one shift a day.
+
+    When numpy is available, the pre-conditions that have a vectorized
+    form (see vectorized()) are applied to all the patterns at once as
+    an (N x 21) uint8 array; the others are applied afterwards to the
+    set of tuples.
     """
+    if numpy is not None:
+        vector_steps = [(func, args) for func, args in pre_condition
+                        if getattr(func, 'vectorized', None) is not None]
+        if vector_steps:
+            patterns = initial_domain_array(vector_steps)
+            possible_shifts = set(map(tuple, patterns.tolist()))
+            for preprocess_func, args in pre_condition:
+                if (preprocess_func, args) in vector_steps:
+                    continue
+                if not args:
+                    possible_shifts = preprocess_func(possible_shifts)
+                else:
+                    possible_shifts = preprocess_func(possible_shifts, *args)
+            return possible_shifts
+
     one_day_shift = [ (0, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1) ]
 
     possible_shifts = set( [ shift_mon + shift_tue + shift_wed + shift_thu + shift_fri + shift_sat + shift_sun
@@ -51,10 +138,291 @@ def initial_domain(pre_condition=[]):
     return possible_shifts
 
 
+def initial_domain_array(pre_condition=[]):
+    """
+    The vectorized counterpart of initial_domain(): all the 4^7 one
+    shift a day patterns as an (N x 21) uint8 array, filtered by the
+    vectorized form of each pre-condition.  Requires numpy.
+    """
+    one_day_shift = numpy.array([ (0, 0, 0), (1, 0, 0), (0, 1, 0), (0, 0, 1) ],
+                                dtype=numpy.uint8)
+    # choice of the day's shift for every pattern, Monday varying slowest
+    choices = numpy.indices((4,) * 7).reshape(7, -1).T
+    patterns = one_day_shift[choices].reshape(-1, 21)
+
+    print len(patterns)
+
+    for preprocess_func, args in pre_condition:
+        mask_func = preprocess_func.vectorized
+        if not args:
+            patterns = patterns[mask_func(patterns)]
+        else:
+            patterns = patterns[mask_func(patterns, *args)]
+        print "%s: %s" % (preprocess_func.__name__, len(patterns))
+
+    return patterns
+
+def vectorized(mask_func):
+    """
+    Decorator giving a pre-condition a vectorized form.  mask_func takes
+    the (N x 21) uint8 array of patterns (and the pre-condition's
+    arguments) and returns a boolean array marking the rows to keep.
+    """
+    def decorate(preprocess_func):
+        preprocess_func.vectorized = mask_func
+        return preprocess_func
+    return decorate
+
+def _on_duty_days(patterns):
+    """
+    (N x 7) boolean array of the days each pattern works.
+    """
+    return patterns.reshape(-1, 7, 3).any(axis=2)
+
+
+## On-disk cache of the domains
+class PatternTable(object):
+    """
+    Read-only sequence of the weighted patterns stored in a file made by
+    cached_domain().  The file holds a header and, in ascending order,
+    one little-endian uint32 per pattern with bit i set when the pattern
+    works shift i.  It is memory-mapped, so the processes that use the
+    same file share its pages, and patterns are only decoded into
+    tuples when they are looked at.  It can be the value table of
+    Employees (all the employees of a title then share it), and it
+    pickles as its path.
+    """
+    MAGIC = 'SSPT'
+    # bump when the file layout or the meaning of the patterns changes
+    VERSION = 1
+    # magic, version, slots, weight, count
+    HEADER = struct.Struct('<4sIIII')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.slots, self.weight, self._count = \
+            PatternTable.HEADER.unpack_from(self._map, 0)
+        if magic != PatternTable.MAGIC or version != PatternTable.VERSION:
+            raise ValueError("%s is not a version %d pattern table"
+                             % (path, PatternTable.VERSION))
+        self.positions = _PatternPositions(self)
+
+    def __reduce__(self):
+        return (PatternTable, (self.path,))
+
+    def __len__(self):
+        return self._count
+
+    def bits(self, index):
+        """
+        The packed pattern at index.
+        """
+        return struct.unpack_from('<I', self._map,
+                                  PatternTable.HEADER.size + 4 * index)[0]
+
+    def encode(self, pattern):
+        """
+        The packed form of a weighted pattern, or None if the pattern
+        cannot be in this table.
+        """
+        if len(pattern) != self.slots:
+            return None
+        bits = 0
+        for i, staff in enumerate(pattern):
+            if staff == self.weight:
+                bits |= 1 << i
+            elif staff:
+                return None
+        return bits
+
+    def decode(self, bits):
+        weight = self.weight
+        return tuple(weight if bits >> i & 1 else 0
+                     for i in xrange(0, self.slots))
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError("pattern table index out of range")
+        return self.decode(self.bits(index))
+
+    def __iter__(self):
+        for index in xrange(0, self._count):
+            yield self.decode(self.bits(index))
+
+class _PackedBits(object):
+    """
+    The packed patterns of a PatternTable as a sequence of ints, for
+    bisect.
+    """
+    def __init__(self, table):
+        self._table = table
+
+    def __len__(self):
+        return len(self._table)
+
+    def __getitem__(self, index):
+        return self._table.bits(index)
+
+class _PatternPositions(object):
+    """
+    Index of each pattern of a PatternTable, found by binary search on
+    the packed patterns rather than kept in a dict.
+    """
+    def __init__(self, table):
+        self._table = table
+        self._bits = _PackedBits(table)
+
+    def get(self, pattern, default=None):
+        bits = self._table.encode(pattern)
+        if bits is None:
+            return default
+        index = bisect.bisect_left(self._bits, bits)
+        if index < len(self._table) and self._table.bits(index) == bits:
+            return index
+        return default
+
+    def __getitem__(self, pattern):
+        index = self.get(pattern)
+        if index is None:
+            raise KeyError(pattern)
+        return index
+
+    def __contains__(self, pattern):
+        return self.get(pattern) is not None
+
+def _domain_key(pre_condition, weight):
+    """
+    Content address of a domain: a digest of the table format version,
+    the weight, the code and arguments of the pre-conditions (and of
+    their vectorized forms), and the source of this module and of the
+    modules defining the pre-conditions.  The sources cover what the
+    pre-conditions call (_is_on_duty(), _on_duty_days(), ...) and the
+    base patterns made by initial_domain(), so editing any of it makes
+    a new cache entry instead of serving stale patterns.
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((PatternTable.VERSION, weight)))
+    modules = [__name__]
+    for preprocess_func, args in pre_condition:
+        funcs = [preprocess_func]
+        if getattr(preprocess_func, 'vectorized', None) is not None:
+            funcs.append(preprocess_func.vectorized)
+        for func in funcs:
+            digest.update(func.__name__)
+            _hash_code(digest, func.__code__)
+            if func.__module__ not in modules:
+                modules.append(func.__module__)
+        _hash_value(digest, args)
+    for module in modules:
+        digest.update(_module_source(module))
+    return digest.hexdigest()
+
+def _hash_code(digest, code):
+    """
+    Add what a code object is made of to digest.  Its repr, like that
+    of the code of a nested function, lambda or generator expression
+    among its constants, holds its address, which changes from one
+    process to the next.
+    """
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names))
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _hash_code(digest, const)
+        else:
+            digest.update(repr(const))
+
+def _hash_value(digest, value):
+    """
+    Add a pre-condition argument to digest, by repr unless that would
+    hold an address: functions go by their code, and objects with the
+    default repr by their class and attributes.
+    """
+    if isinstance(value, (list, tuple)):
+        digest.update("%s(%d" % (type(value).__name__, len(value)))
+        for item in value:
+            _hash_value(digest, item)
+    elif isinstance(value, dict):
+        digest.update("dict(%d" % len(value))
+        for key in sorted(value):
+            _hash_value(digest, key)
+            _hash_value(digest, value[key])
+    elif isinstance(value, types.FunctionType):
+        digest.update(value.__name__)
+        _hash_code(digest, value.__code__)
+    elif isinstance(value, types.MethodType):
+        _hash_value(digest, value.__func__)
+        _hash_value(digest, value.__self__)
+    elif numpy is not None and isinstance(value, numpy.ndarray):
+        digest.update(repr((value.dtype.str, value.shape)))
+        digest.update(value.tostring())
+    elif isinstance(value, types.InstanceType) or \
+            type(value).__repr__ is object.__repr__:
+        digest.update("%s.%s" % (value.__class__.__module__,
+                                 value.__class__.__name__))
+        _hash_value(digest, getattr(value, '__dict__', {}))
+    else:
+        digest.update(repr(value))
+
+# module name -> its source, read once per process
+_module_sources = {}
+
+def _module_source(name):
+    if name not in _module_sources:
+        try:
+            source = inspect.getsource(sys.modules[name])
+        except (KeyError, IOError, TypeError):
+            # no source to go by (e.g. interactive); key on the name
+            source = name
+        _module_sources[name] = source
+    return _module_sources[name]
+
+def _default_cache_dir():
+    return os.environ.get('SS_CSP_CACHE',
+                          os.path.join(os.path.expanduser('~'), '.cache',
+                                       'ss_csp'))
+
+def cached_domain(pre_condition=[], weight=1, cache_dir=None):
+    """
+    initial_domain(pre_condition) weighted by weight (see
+    weight_by_title), as a PatternTable read from the disk cache.  The
+    file is named after _domain_key(), so changing a pre-condition, its
+    arguments or the weight makes a new one; it is built with
+    initial_domain() the first time and written atomically, so
+    concurrent processes can share the cache.
+    """
+    if cache_dir is None:
+        cache_dir = _default_cache_dir()
+    path = os.path.join(cache_dir,
+                        _domain_key(pre_condition, weight) + '.patterns')
+    if not os.path.exists(path):
+        patterns = initial_domain(pre_condition)
+        packed = sorted(sum(1 << i for i, staff in enumerate(pattern) if staff)
+                        for pattern in patterns)
+        slots = len(next(iter(patterns))) if packed else 21
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        temporary = "%s.%d.tmp" % (path, os.getpid())
+        with open(temporary, 'wb') as f:
+            f.write(PatternTable.HEADER.pack(PatternTable.MAGIC,
+                                             PatternTable.VERSION, slots,
+                                             weight, len(packed)))
+            f.write(struct.pack('<%dI' % len(packed), *packed))
+        os.rename(temporary, path)
+    return PatternTable(path)
+
 class GloabalConstraint(object):
     """
     A global constraint object which involves all the variables of the problem.
     """
+    # whether swapping the values of any two of its variables never
+    # changes the outcome of a check (see SS_CSP.interchangeable_classes)
+    symmetric = False
+
     def __init__(self, var_names, check_func, description):
         self._var_names = var_names[:]
         self._check_func = check_func
@@ -82,25 +450,276 @@ class GloabalConstraint(object):
     def __str__(self):
         return "Glabal constraint: %s" % self._description
 
+class CoverageConstraint(GloabalConstraint):
+    """
+    Global cardinality constraint on the staffing of every shift: the
+    sum over var_names of the values for shift i must lie within
+    min_staff[i] and max_staff[i] (an int applies to every shift).  With
+    Employee variables the values are weighted by title, so the bounds
+    are in the same weighted units as shift_weighted_sum().
+
+    Instead of rebuilding a roster map on every check, the constraint
+    keeps, per state, the staffing of each shift by the assigned
+    variables and the most the unassigned ones could still supply, and
+    updates both as variables are assigned or their domains shrink.
+    A check is then O(number of shifts).  propagate() uses the same
+    counts to prune domains by bounds.
+    """
+    symmetric = True
+
+    def __init__(self, var_names, min_staff, max_staff, description=None,
+                 slots=21):
+        if description is None:
+            description = "shift staffing within [%s, %s]" %(min_staff, max_staff)
+        GloabalConstraint.__init__(self, var_names, self._check_roster,
+                                   description)
+        if not isinstance(min_staff, (list, tuple)):
+            min_staff = [min_staff] * slots
+        if not isinstance(max_staff, (list, tuple)):
+            max_staff = [max_staff] * slots
+        self._min_staff = list(min_staff)
+        self._max_staff = list(max_staff)
+        self._slots = len(self._min_staff)
+        # var name -> per shift, the most one of its values puts on it
+        self._peaks = {}
+        # var name -> per shift, mask of the values working it (bitset
+        # variables only)
+        self._working_masks = {}
+
+    def _check_roster(self, var_name_value_map):
+        """
+        check_func on a roster map: only upper bounds can be judged on a
+        partial roster.
+        """
+        totals = map(sum, zip(*var_name_value_map.values()))
+        complete = len(var_name_value_map) == len(self._var_names)
+        for i in xrange(0, self._slots):
+            if totals[i] > self._max_staff[i]:
+                return False
+            if complete and totals[i] < self._min_staff[i]:
+                return False
+        return True
+
+    def _peak(self, variable):
+        name = variable.get_name()
+        if name not in self._peaks:
+            if isinstance(variable, BitsetVariable):
+                values = variable.get_value_table()
+            else:
+                values = variable.get_domain()
+            peak = [0] * self._slots
+            for value in values:
+                peak = map(max, peak, value)
+            self._peaks[name] = peak
+            uniform = True
+            for value in values:
+                for i in xrange(0, self._slots):
+                    if value[i] and value[i] != peak[i]:
+                        uniform = False
+            # set operations only stand for the bounds when a value puts
+            # either nothing or the peak on each shift
+            if uniform and isinstance(variable, BitsetVariable):
+                masks = [0] * self._slots
+                for position, value in enumerate(values):
+                    for i in xrange(0, self._slots):
+                        if value[i]:
+                            masks[i] |= 1 << position
+                self._working_masks[name] = masks
+        return self._peaks[name]
+
+    def contribution(self, variable):
+        """
+        (assigned, supply): what variable puts on each shift if it is
+        assigned, and the most it can put on each shift otherwise.
+        """
+        if variable.is_assigned():
+            return variable.get_assigned_value(), None
+        peak = self._peak(variable)
+        masks = self._working_masks.get(variable.get_name())
+        if masks is not None:
+            mask = variable.get_mask()
+            return None, [peak[i] if mask & masks[i] else 0
+                          for i in xrange(0, self._slots)]
+        supply = [0] * self._slots
+        for value in variable.get_domain():
+            supply = map(max, supply, value)
+        return None, supply
+
+    def _staffing(self, state):
+        staffing = state.get_watcher(self)
+        if staffing is None:
+            staffing = _ShiftStaffing(self, state)
+            state.add_watcher(self, staffing)
+        return staffing
+
+    def check(self, state, var_j_name=None, val_j=None):
+        staffing = self._staffing(state)
+        assigned = staffing.assigned
+        supply = staffing.supply
+        if var_j_name and val_j and \
+                not state.get_variable_by_name(var_j_name).is_assigned():
+            # as if var_j_name were assigned val_j
+            own_supply = staffing.contributions[var_j_name][1]
+            for i in xrange(0, self._slots):
+                staff = assigned[i] + val_j[i]
+                if staff > self._max_staff[i]:
+                    return False
+                if staff + supply[i] - own_supply[i] < self._min_staff[i]:
+                    return False
+            return True
+
+        for i in xrange(0, self._slots):
+            if assigned[i] > self._max_staff[i]:
+                return False
+            if assigned[i] + supply[i] < self._min_staff[i]:
+                return False
+        return True
+
+    def violation(self, state):
+        """
+        By how many (weighted) staff the shifts are over or under their
+        bounds in a complete roster; used by local_search.
+        """
+        assigned = self._staffing(state).assigned
+        amount = 0
+        for i in xrange(0, self._slots):
+            if assigned[i] > self._max_staff[i]:
+                amount += assigned[i] - self._max_staff[i]
+            elif assigned[i] < self._min_staff[i]:
+                amount += self._min_staff[i] - assigned[i]
+        return amount
+
+    def propagate(self, state):
+        """
+        Remove from the domains of the unassigned variables the values
+        that would overstaff a shift, or that leave a shift without
+        enough possible staff, until nothing changes.  Returns False when
+        a domain is wiped out or a shift can no longer be staffed.
+        """
+        staffing = self._staffing(state)
+        changed = True
+        while changed:
+            changed = False
+            if not self.check(state):
+                return False
+            for name in self._var_names:
+                variable = state.get_variable_by_name(name)
+                if variable.is_assigned():
+                    continue
+                own_supply = staffing.contributions[name][1]
+                masks = self._working_masks.get(name)
+                if masks is None:
+                    for value in variable.get_domain():
+                        if not self.check(state, name, value):
+                            variable.reduce_domain(value)
+                            changed = True
+                else:
+                    # bounds on each shift rule out whole sets of values
+                    keep = variable.get_mask()
+                    for i in xrange(0, self._slots):
+                        other = staffing.supply[i] - own_supply[i]
+                        if staffing.assigned[i] + own_supply[i] > \
+                                self._max_staff[i]:
+                            keep &= ~masks[i]
+                        if staffing.assigned[i] + other < self._min_staff[i]:
+                            keep &= masks[i]
+                    if keep != variable.get_mask():
+                        variable.set_mask(keep)
+                        changed = True
+                if variable.domain_size() == 0:
+                    return False
+        return True
+
+class LexOrderConstraint(GloabalConstraint):
+    """
+    The values of var_names must be in non-decreasing order, which keeps
+    only one of the rosters that differ by a permutation of
+    interchangeable variables (see SS_CSP.break_symmetry).
+    Unassigned variables are skipped.
+    """
+    def __init__(self, var_names, description=None):
+        if description is None:
+            description = "%s in non-decreasing order" % (", ".join(var_names))
+        GloabalConstraint.__init__(self, var_names, None, description)
+
+    def check(self, state, var_j_name=None, val_j=None):
+        previous = None
+        for name in self._var_names:
+            var = state.get_variable_by_name(name)
+            value = var.get_assigned_value()
+            if name == var_j_name and value is None:
+                value = val_j
+            if value is None:
+                continue
+            if previous is not None and value < previous:
+                return False
+            previous = value
+        return True
+
+class _ShiftStaffing(object):
+    """
+    State watcher of a CoverageConstraint: per shift, the staff put on
+    it by the assigned variables and the most the unassigned ones could
+    still supply, along with each variable's share of both.
+    """
+    def __init__(self, constraint, state=None):
+        self._constraint = constraint
+        if state is None:
+            return
+        slots = constraint._slots
+        self.assigned = [0] * slots
+        self.supply = [0] * slots
+        self.contributions = {}
+        for name in constraint.get_variable_names():
+            variable = state.get_variable_by_name(name)
+            contribution = constraint.contribution(variable)
+            self.contributions[name] = contribution
+            self._add(contribution, 1)
+
+    def copy(self):
+        staffing = _ShiftStaffing(self._constraint)
+        staffing.assigned = self.assigned[:]
+        staffing.supply = self.supply[:]
+        staffing.contributions = self.contributions.copy()
+        return staffing
+
+    def _add(self, contribution, sign):
+        assigned, supply = contribution
+        if assigned is not None:
+            for i in xrange(0, len(self.assigned)):
+                self.assigned[i] += sign * assigned[i]
+        if supply is not None:
+            for i in xrange(0, len(self.supply)):
+                self.supply[i] += sign * supply[i]
+
+    def variable_changed(self, variable):
+        name = variable.get_name()
+        old = self.contributions.get(name)
+        if old is None:
+            return
+        new = self._constraint.contribution(variable)
+        if new != old:
+            self._add(old, -1)
+            self._add(new, 1)
+            self.contributions[name] = new
+
 class SS_CSPState(CSPState):
-    def get_constraints_by_name(self, variable_name):
-        constraints = []
-        for key, val in self.constraint_map.items():
-            if set(key).issuperset( set([variable_name]) ):
-                constraints += val
-        return constraints
+    pass
 
 class SS_CSP(CSP):
     def __init__(self, constraints, variables):
         self.constraint_map = {}
         for constraint in constraints:
-            tup = constraint.get_variable_names()
+            tup = tuple(constraint.get_variable_names())
             if tup not in self.constraint_map:
                 lst = []
                 self.constraint_map[tup] = lst
             else:
                 lst = self.constraint_map[tup]
             lst.append(constraint)
+        self.constraint_index = ConstraintIndex(constraints)
+        self.constraint_tables = {}
+        self.check_cache = None
 
         self.variable_map = {}
         self.variable_order = []
@@ -110,9 +729,105 @@ class SS_CSP(CSP):
 
     def initial_state(self):
         return SS_CSPState(self.constraint_map, self.variable_map,
-                           self.variable_order, -1)
+                           self.variable_order, -1,
+                           constraint_index=self.constraint_index)
+
+    def interchangeable_classes(self):
+        """
+        Group the variables that can swap values in any solution: the
+        same title, the same domain and the same constraints, all of
+        them symmetric.  Returns the groups of two or more variable
+        names, each in variable_order.
+        """
+        classes = {}
+        keys = []
+        for name in self.variable_order:
+            var = self.variable_map[name]
+            constraints = self.constraint_index.incident(name)
+            if not all(getattr(c, 'symmetric', False) for c in constraints):
+                continue
+            if isinstance(var, BitsetVariable):
+                domain = frozenset(var.get_value_table()) \
+                    if var.domain_size() == len(var.get_value_table()) \
+                    else frozenset(var.get_domain())
+            else:
+                domain = frozenset(var.get_domain())
+            title = getattr(var, 'get_title', lambda: None)()
+            key = (title, domain, frozenset(constraints))
+            if key not in classes:
+                classes[key] = []
+                keys.append(key)
+            classes[key].append(name)
+        return [classes[key] for key in keys if len(classes[key]) > 1]
+
+    def break_symmetry(self):
+        """
+        Add a LexOrderConstraint over every class of interchangeable
+        variables, so that the search only visits one roster out of
+        those that differ by swapping their values.  Use
+        symmetric_solutions() to get the others back.  Returns the
+        classes.
+        """
+        classes = self.interchangeable_classes()
+        constraints = list(self.constraint_index.all())
+        constraints.extend(LexOrderConstraint(names) for names in classes)
+        variables = [self.variable_map[name] for name in self.variable_order]
+        SS_CSP.__init__(self, constraints, variables)
+        return classes
+
+def symmetric_solutions(solution, classes):
+    """
+    All the distinct solutions that follow from a solution() by
+    permuting the values within each class of interchangeable variables
+    (see SS_CSP.break_symmetry).  The canonical solution the search
+    finds comes first.  They are generated one at a time, as there can
+    be very many.
+    """
+    assignment = dict(solution)
+    names = [name for name, value in solution]
+
+    def permute(k):
+        if k == len(classes):
+            yield [(name, assignment[name]) for name in names]
+            return
+        variables = classes[k]
+        values = [assignment[name] for name in variables]
+        for permutation in _distinct_permutations(values):
+            assignment.update(zip(variables, permutation))
+            for permuted in permute(k + 1):
+                yield permuted
+        assignment.update(zip(variables, values))
+
+    return permute(0)
+
+def _distinct_permutations(values):
+    """
+    The distinct orderings of values in lexicographic order, from the
+    sorted one.
+    """
+    p = sorted(values)
+    while True:
+        yield tuple(p)
+        # next permutation: the rightmost ascent, swapped with the
+        # rightmost greater value, and the tail reversed
+        i = len(p) - 2
+        while i >= 0 and p[i] >= p[i + 1]:
+            i -= 1
+        if i < 0:
+            return
+        j = len(p) - 1
+        while p[j] <= p[i]:
+            j -= 1
+        p[i], p[j] = p[j], p[i]
+        p[i + 1:] = reversed(p[i + 1:])
 
 ## Preprocess functions for the domain
+def _no_evening_shift_before_morning_shift_mask(patterns):
+    evenings = patterns[:, 2:18:3]
+    next_mornings = patterns[:, 3:21:3]
+    return ~(evenings & next_mornings).any(axis=1)
+
+@vectorized(_no_evening_shift_before_morning_shift_mask)
 def no_evening_shift_before_morning_shift(possible_shifts):
     to_be_removed = set([])
     for shift in possible_shifts:
@@ -125,6 +840,11 @@ def no_evening_shift_before_morning_shift(possible_shifts):
     print "no_evening_shift_before_morning_shift: %s" % len(ps_set)
     return ps_set
 
+def _rest_days_mask(patterns):
+    rest = 7 - _on_duty_days(patterns).sum(axis=1)
+    return (rest >= 1) & (rest <= 2)
+
+@vectorized(_rest_days_mask)
 def rest_days(possible_shifts):
     to_be_removed = set([])
     for shift in possible_shifts:
@@ -140,6 +860,12 @@ def rest_days(possible_shifts):
     print "one_day_rest: %s" % len(ps_set)
     return ps_set
 
+def _at_most_three_days_work_in_a_row_mask(patterns):
+    on = _on_duty_days(patterns)
+    four_in_a_row = on[:, :-3] & on[:, 1:-2] & on[:, 2:-1] & on[:, 3:]
+    return ~four_in_a_row.any(axis=1)
+
+@vectorized(_at_most_three_days_work_in_a_row_mask)
 def at_most_three_days_work_in_a_row(possible_shifts):
     to_be_removed = set([])
     for shift in possible_shifts:
@@ -157,6 +883,11 @@ def at_most_three_days_work_in_a_row(possible_shifts):
     print "at_most_three_days_work_in_a_row: %s" % len(ps_set)
     return ps_set
 
+def _no_two_days_rest_in_a_row_mask(patterns):
+    rest = ~_on_duty_days(patterns)
+    return ~(rest[:, :-1] & rest[:, 1:]).any(axis=1)
+
+@vectorized(_no_two_days_rest_in_a_row_mask)
 def no_two_days_rest_in_a_row(possible_shifts):
     to_be_removed = set([])
     for shift in possible_shifts:
@@ -195,6 +926,24 @@ def global_constraint_checker(state, verbose):
                 return False
     return True
 
+def incremental_global_constraint_checker(state, verbose):
+    """
+    Same as global_constraint_checker, but only checks the global
+    constraints the variable assigned last takes part in; the others
+    were already checked higher up the search tree.
+    """
+    curr_var_name = state.get_current_variable_name()
+    if not curr_var_name:
+        return True
+
+    for constraint in state.get_incident_constraints(curr_var_name):
+        if isinstance(constraint, GloabalConstraint):
+            if not constraint.check(state):
+                if verbose:
+                    print "CONSTRAINT-FAILS: %s" %(constraint)
+                return False
+    return True
+
 def global_forward_checking(state, verbose):
     basic = global_constraint_checker(state, verbose)
     if not basic:
@@ -206,6 +955,11 @@ def global_forward_checking(state, verbose):
         return True
 
     for constraint in state.get_all_constraints():
+        if isinstance(constraint, CoverageConstraint):
+            if not constraint.propagate(state):
+                return False
+            continue
+
         all_var_names = constraint.get_variable_names()
         for var_j_name in  all_var_names:
             var_j = state.get_variable_by_name(var_j_name)
@@ -219,7 +973,110 @@ def global_forward_checking(state, verbose):
 
     return True
 
-import itertools
+def search_schedule(domain, number_of_staff, min_staff=1, max_staff=2,
+                    slots_per_day=3):
+    """
+    Find number_of_staff weekly patterns of domain (repetitions allowed)
+    such that every shift is worked by min_staff to max_staff of them.
+
+    Employees are given a pattern one at a time while the running staff
+    count of every shift is kept.  Each step picks a shift that is
+    still short of min_staff and has the fewest patterns left that cover
+    it without pushing any shift over max_staff.  It then branches on
+    those patterns, so the search never wanders through patterns that
+    do not help.  A pattern that failed in one branch is excluded from
+    its later siblings, so no roster is explored twice.  A branch is cut
+    as soon as some short shift has no candidate left.  It is also cut
+    when the staff still to place cannot make up the shortfall of some
+    day, since a pattern puts at most the domain's maximum per-day staff
+    on a day.
+
+    returns the schedule as a tuple of patterns, or None.
+    """
+    if not domain:
+        return None
+    slots = len(domain[0])
+    # worked[k]: (shift, staff) for the shifts pattern k works
+    worked = [[(i, d[i]) for i in xrange(0, slots) if d[i]] for d in domain]
+    covering = [[k for k in xrange(0, len(domain)) if domain[k][i]]
+                for i in xrange(0, slots)]
+    day_starts = range(0, slots, slots_per_day)
+    max_day_staff = max(sum(d[start:start + slots_per_day])
+                        for d in domain for start in day_starts)
+
+    coverage = [0] * slots
+    schedule = []
+    excluded = set()
+
+    def fits(k):
+        for i, staff in worked[k]:
+            if coverage[i] + staff > max_staff:
+                return False
+        return True
+
+    def place(k):
+        for i, staff in worked[k]:
+            coverage[i] += staff
+        schedule.append(domain[k])
+
+    def unplace(k):
+        for i, staff in worked[k]:
+            coverage[i] -= staff
+        schedule.pop()
+
+    def fill(start, remaining):
+        """
+        Every shift has min_staff: give the remaining employees any
+        patterns that fit, in non-decreasing domain order.
+        """
+        if remaining == 0:
+            return True
+        for k in xrange(start, len(domain)):
+            if k in excluded or not fits(k):
+                continue
+            place(k)
+            if fill(k, remaining - 1):
+                return True
+            unplace(k)
+        return False
+
+    def extend(remaining):
+        short = [i for i in xrange(0, slots) if coverage[i] < min_staff]
+        if not short:
+            return fill(0, remaining)
+        if remaining == 0:
+            return False
+        for start in day_starts:
+            shortfall = 0
+            for i in xrange(start, start + slots_per_day):
+                if coverage[i] < min_staff:
+                    shortfall += min_staff - coverage[i]
+            if shortfall > remaining * max_day_staff:
+                return False
+
+        candidates = None
+        for i in short:
+            fitting = [k for k in covering[i] if k not in excluded and fits(k)]
+            if not fitting:
+                return False
+            if candidates is None or len(fitting) < len(candidates):
+                candidates = fitting
+
+        tried = []
+        for k in candidates:
+            place(k)
+            if extend(remaining - 1):
+                return True
+            unplace(k)
+            excluded.add(k)
+            tried.append(k)
+        excluded.difference_update(tried)
+        return False
+
+    if extend(number_of_staff):
+        return tuple(schedule)
+    return None
+
 def shift_schedule_problem():
     staff = [('John', 'Manager'),
  #            ('Joe', 'Manager'),
@@ -257,26 +1114,270 @@ def shift_schedule_problem():
 
     print domain_statistics
 
-    count = 0
-    for schedule in itertools.combinations_with_replacement(domain, 5):
-        success_shift_number = 0
-        for shift in zip(*schedule):
-            number_of_staff = reduce(lambda x,y: x+y, shift)
-            if number_of_staff <= 2 and number_of_staff >= 1 :
-                success_shift_number += 1
-            else:
-                break
+    if 0 in domain_statistics:
+        # some shift cannot be worked by anyone
+        return None
 
-        if success_shift_number == 21:
-            return schedule
+    return search_schedule(domain, 5, min_staff=1, max_staff=2)
 
-    return None
 
+def shift_schedule_csp(staff, domain, min_staff, max_staff):
+    """
+    The shift scheduling problem as an SS_CSP: an Employee per (name,
+    title) of staff, over the weekly patterns of domain, and a
+    CoverageConstraint keeping the weighted staffing of every shift
+    within min_staff and max_staff.  Too big for CSP.solve() with the
+    whole staff list, but local_search.min_conflicts() takes it.
+    """
+    variables = employees(staff, domain)
+    names = [var.get_name() for var in variables]
+    return SS_CSP([CoverageConstraint(names, min_staff, max_staff)],
+                  variables)
+
+## Rolling horizon: one week at a time
+def _on_duty_flags(pattern, slots_per_day=3):
+    return [_is_on_duty(pattern[i:i + slots_per_day])
+            for i in xrange(0, len(pattern), slots_per_day)]
+
+def week_boundary(pattern, slots_per_day=3):
+    """
+    What the next week needs to know of a weekly pattern: whether it
+    works the last shift of Sunday, and how many days in a row it works
+    and rests at the end of the week.
+    """
+    days = _on_duty_flags(pattern, slots_per_day)
+    trailing_work = 0
+    trailing_rest = 0
+    for on_duty in reversed(days):
+        if not on_duty:
+            break
+        trailing_work += 1
+    for on_duty in reversed(days):
+        if on_duty:
+            break
+        trailing_rest += 1
+    return (bool(pattern[-1]), trailing_work, trailing_rest)
+
+def follows_boundary(pattern, boundary, slots_per_day=3):
+    """
+    Whether a weekly pattern can follow a week that ended with
+    boundary (see week_boundary()) without breaking, across the two
+    weeks, no_evening_shift_before_morning_shift,
+    at_most_three_days_work_in_a_row or no_two_days_rest_in_a_row.
+    """
+    evening, trailing_work, trailing_rest = boundary
+    if evening and pattern[0]:
+        return False
+    days = _on_duty_flags(pattern, slots_per_day)
+    if trailing_rest and not days[0]:
+        return False
+    leading_work = 0
+    for on_duty in days:
+        if not on_duty:
+            break
+        leading_work += 1
+    return trailing_work + leading_work <= 3
+
+def _solve_week(problem):
+    # a week over thousands of patterns per employee is too big for
+    # CSP.solve(); min-conflicts over a sample of each domain finishes
+    # in a few steps, and the fixed seed keeps the rosters repeatable
+    return local_search.min_conflicts(problem, max_steps=2000, restarts=20,
+                                      max_candidates=200, seed=0)
+
+def schedule_weeks(staff, domain, weeks, min_staff, max_staff,
+                   boundaries=None, solve_week=_solve_week,
+                   slots_per_day=3):
+    """
+    Schedule staff over a number of weeks, one week at a time, instead
+    of over patterns spanning all the weeks.
+
+    Every week is a shift_schedule_csp() problem over the weekly
+    patterns of domain.  What each employee's previous week ends with
+    (see week_boundary()) narrows their domain to the patterns that may
+    follow it, so the pre-conditions keep holding across weeks.
+    boundaries gives the ones of the week before the first, by employee
+    name.  Patterns are filtered once per distinct boundary, so every
+    week costs about the same and the work grows linearly with the
+    number of weeks.  solve_week takes the week's problem and returns
+    its solution() or None; by default local_search.min_conflicts(),
+    which may give up on a week that has a roster.  Pass a solver
+    built on CSP.solve() for a complete search of a small staff.
+
+    returns the list of the weekly rosters (solution()s), or None if
+    some week cannot be scheduled.
+    """
+    if boundaries is None:
+        boundaries = {}
+    rosters = []
+    for week in xrange(0, weeks):
+        # boundary -> the patterns of domain that may follow it
+        following = {None: domain}
+        # (boundary, title) -> those patterns, weighted for the title
+        weighted = {}
+        variables = []
+        for name, title in staff:
+            boundary = boundaries.get(name)
+            if boundary not in following:
+                following[boundary] = [
+                    d for d in domain
+                    if follows_boundary(d, boundary, slots_per_day)]
+            if (boundary, title) not in weighted:
+                weighted[(boundary, title)] = weighted_patterns(
+                    following[boundary], weight_by_title[title])
+            variables.append(Employee(name, title,
+                                      weighted[(boundary, title)]))
+        names = [var.get_name() for var in variables]
+        problem = SS_CSP([CoverageConstraint(names, min_staff, max_staff)],
+                         variables)
+
+        roster = solve_week(problem)
+        if roster is None:
+            return None
+        rosters.append(roster)
+        boundaries = dict((name, week_boundary(value, slots_per_day))
+                          for name, value in roster)
+    return rosters
 
 def shift_weighted_sum(shift_value):
     return reduce(lambda x,y: x+y, shift_value)
 
+def roster_cost(state):
+    """
+    Objective for CSP.solve_optimal(): the weighted number of shifts
+    worked by the assigned employees.
+    """
+    cost = 0
+    for var in state.get_all_variables():
+        if var.is_assigned():
+            cost += shift_weighted_sum(var.get_assigned_value())
+    return cost
+
+class RosterCostLowerBound(object):
+    """
+    Admissible lower bound for roster_cost(): the cost of the assigned
+    employees plus, for every other one, the cheapest pattern left in
+    its domain.  Use one per problem, e.g.
+    problem.solve_optimal(roster_cost, RosterCostLowerBound()).
+
+    For bitset variables the bit positions of the value table are
+    sorted by cost once, and the cheapest pattern left is the first of
+    them still in the domain.  That order is kept by the bound itself,
+    so it goes away with it.
+    """
+    def __init__(self):
+        # variable name -> (its value table, the bit positions cheapest
+        # pattern first, their weighted sums)
+        self._orders = {}
+
+    def __call__(self, state):
+        cost = 0
+        for var in state.get_all_variables():
+            if var.is_assigned():
+                cost += shift_weighted_sum(var.get_assigned_value())
+            else:
+                cheapest = self.cheapest(var)
+                if cheapest is not None:
+                    cost += cheapest
+        return cost
+
+    def cheapest(self, var):
+        """
+        Weighted sum of the cheapest pattern left in the domain of var,
+        None if the domain is empty.
+        """
+        if not isinstance(var, BitsetVariable):
+            sums = [shift_weighted_sum(v) for v in var.get_domain()]
+            return min(sums) if sums else None
+
+        table = var.get_value_table()
+        order = self._orders.get(var.get_name())
+        if order is None or order[0] is not table:
+            sums = [shift_weighted_sum(v) for v in table]
+            positions = sorted(xrange(len(table)), key=sums.__getitem__)
+            order = (table, positions, [sums[k] for k in positions])
+            self._orders[var.get_name()] = order
+        mask = var.get_mask()
+        for position, weighted_sum in itertools.izip(order[1], order[2]):
+            if mask >> position & 1:
+                return weighted_sum
+        return None
+
+def _within(roster, min_staff, max_staff):
+    return all(min_staff <= sum(staff) <= max_staff
+               for staff in zip(*roster))
+
 if __name__ == '__main__':
+    ## test search_schedule() against trying every roster
+    rng = random.Random(0)
+    two_day_patterns = list(itertools.product([0, 1], repeat=6))[1:]
+    for trial in xrange(0, 200):
+        test_domain = rng.sample(two_day_patterns, rng.randint(1, 10))
+        number_of_staff = rng.randint(1, 5)
+        low = rng.randint(1, 2)
+        high = low + rng.randint(0, 1)
+        expected = any(_within(roster, low, high) for roster in
+                       itertools.combinations_with_replacement(
+                           test_domain, number_of_staff))
+        result = search_schedule(test_domain, number_of_staff, low, high)
+        assert (result is not None) == expected
+        if result is not None:
+            assert len(result) == number_of_staff
+            assert _within(result, low, high)
+            assert all(pattern in test_domain for pattern in result)
+
+    ## test break_symmetry() and symmetric_solutions()
+    def symmetric_problem():
+        day = [d for d in itertools.product([0, 1], repeat=3) if any(d)]
+        employees = [Employee('M0', 'Manager', day),
+                     Employee('M1', 'Manager', day),
+                     Employee('S0', 'Sales', day),
+                     Employee('S1', 'Sales', day),
+                     Employee('S2', 'Sales', day),
+                     Employee('X', 'Sales', day[:4])]
+        names = [e.get_name() for e in employees]
+        return SS_CSP([CoverageConstraint(names, [101, 101, 2],
+                                          [202, 202, 202], slots=3)],
+                      employees)
+    full = set(tuple(solution) for solution in
+               symmetric_problem().solve_iter(global_forward_checking))
+    problem = symmetric_problem()
+    classes = problem.break_symmetry()
+    assert [['M0', 'M1'], ['S0', 'S1', 'S2']] == classes
+    canonical = list(problem.solve_iter(global_forward_checking))
+    expanded = [tuple(permuted) for solution in canonical
+                for permuted in symmetric_solutions(solution, classes)]
+    assert 25863 == len(full)
+    assert 3032 == len(canonical)
+    assert len(full) == len(expanded)
+    assert full == set(expanded)
+
+    ## test solve_parallel() with a roster checker
+    solutions = solve_parallel(symmetric_problem, global_forward_checking,
+                               processes=2, all_solutions=True)
+    assert len(full) == len(solutions)
+    assert full == set(tuple(solution) for solution in solutions)
+    solution = solve_parallel(symmetric_problem, global_forward_checking,
+                              processes=2)
+    assert tuple(solution) in full
+
+    ## test schedule_weeks() with its default week solver
+    week_domain = list(initial_domain([
+        (no_evening_shift_before_morning_shift, []),
+        (rest_days, []),
+        (at_most_three_days_work_in_a_row, []),
+        (no_two_days_rest_in_a_row, [])]))
+    week_staff = [('John', 'Manager'), ('Joe', 'Manager'),
+                  ('AA', 'Sales'), ('BB', 'Sales'), ('CC', 'Sales')]
+    rosters = schedule_weeks(week_staff, week_domain, 2, 1, 201)
+    assert rosters is not None and len(rosters) == 2
+    for roster in rosters:
+        totals = map(sum, zip(*[value for name, value in roster]))
+        assert all(1 <= total <= 201 for total in totals)
+    first = dict(rosters[0])
+    for name, value in rosters[1]:
+        assert follows_boundary(value, week_boundary(first[name]))
+
     result = shift_schedule_problem()
     if result:
         print "%s" % (result,)